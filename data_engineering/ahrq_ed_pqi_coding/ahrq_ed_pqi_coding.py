@@ -10,174 +10,1195 @@ This file only needs to be updated when AHRQ updates their logic.
 
 AHRQ PQE Technical Specifications site: https://qualityindicators.ahrq.gov/measures/ED_PQI_TechSpec
 
+Usage:
+  python ahrq_ed_pqi_coding.py build                          (build the code set artifact)
+  python ahrq_ed_pqi_coding.py score claims.csv scored.csv    (flag claims against it)
+  python ahrq_ed_pqi_coding.py rates scored.csv rates.csv      (aggregate flagged claims into rates)
+  python ahrq_ed_pqi_coding.py diff V2023 V2024               (compare two built versions)
+
 requirements.txt included in this directory. Executed in Python 3.10.
 '''
 
-# online path to AHRQ Excel files
-path = 'https://qualityindicators.ahrq.gov/Downloads/Modules/ED_PQI/V2023/TechSpecs/ED_PQI_2023_ICD10_techspecs_excel.zip'
+# AHRQ spec version to build, and the online path to its Excel files
+spec_version = 'V2023'
+spec_url_template = 'https://qualityindicators.ahrq.gov/Downloads/Modules/ED_PQI/{version}/TechSpecs/ED_PQI_{year}_ICD10_techspecs_excel.zip'
 
 
+# pandas, numpy and openpyxl are imported inside the functions that use them, so importing this
+# module (e.g. to load a prebuilt code set) stays cheap and never touches the network
 import urllib.request
 from zipfile import ZipFile
 from io import BytesIO
-import tempfile
+import argparse
+import functools
+import hashlib
+import json
 import os
-import numpy as np
-import pandas as pd
-import openpyxl
+import pickle
 import shutil
 import re
 import datetime
+import uuid
+from xml.etree import ElementTree
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Local cache of the downloaded spec zips. Set AHRQ_PQI_OFFLINE=1 to only read from the
+# cache, e.g. on nodes without internet access.
+cache_dir = os.getenv('AHRQ_PQI_CACHE_DIR', os.path.expanduser('~/.cache/ahrq_ed_pqi'))
+offline = os.getenv('AHRQ_PQI_OFFLINE', '0') == '1'
 
 
 
-# Un-zip the Excel files in a temporary file location
+# Download the spec zip once into the local, content-addressed cache
 ####################################################################
 
-url_loc = urllib.request.urlopen(path)
-zfile = ZipFile(BytesIO(url_loc.read()))
-# Create the temporary directory to store the zip file's content
-temp_dir = tempfile.TemporaryDirectory()
+# Online path of the zip for a spec version (V2023 and later)
+def spec_url(version):
+
+    version_match = re.fullmatch(r'V(\d{4})', version)
+    if version_match is None or int(version_match.group(1)) < 2023:
+        raise ValueError(f'Unsupported AHRQ spec version {version!r}; expected V2023 or later.')
+
+    return spec_url_template.format(version=version, year=version_match.group(1))
+
+
+# Write a file through a temporary name so readers never see a partial file
+def write_atomic(file_path, content):
+
+    os.makedirs(os.path.dirname(file_path) or os.curdir, exist_ok=True)
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(content)
+    os.replace(temp_path, file_path)
+
+
+# Return the local path of the spec zip, downloading it only if the cache does not have it.
+# Zips are stored by their SHA-256 under blobs/, and versions/<version>.json points to the blob.
+def fetch_spec_zip(version=spec_version, cache_dir=cache_dir, offline=offline):
+
+    version_file = os.path.join(cache_dir, 'versions', f'{version}.json')
 
-# Extract the zip file's content into the temporary directory
-zfile.extractall(temp_dir.name)
+    if os.path.exists(version_file):
+        with open(version_file) as file:
+            version_entry = json.load(file)
+        zip_path = os.path.join(cache_dir, 'blobs', f"{version_entry['sha256']}.zip")
 
-# Print the files names in the directory
-os.listdir(temp_dir.name)
+        # Only trust the cached zip if its content still matches its address
+        if os.path.exists(zip_path):
+            with open(zip_path, 'rb') as file:
+                if hashlib.sha256(file.read()).hexdigest() == version_entry['sha256']:
+                    return zip_path
 
+    if offline:
+        raise FileNotFoundError(f'AHRQ spec {version} is not in the cache at {cache_dir} and offline mode is on.')
+
+    url = spec_url(version)
+    content = urllib.request.urlopen(url).read()
+    sha256 = hashlib.sha256(content).hexdigest()
+    zip_path = os.path.join(cache_dir, 'blobs', f'{sha256}.zip')
+
+    write_atomic(zip_path, content)
+    write_atomic(version_file, json.dumps({
+      'version': version,
+      'url': url,
+      'sha256': sha256,
+      'downloaded': datetime.datetime.now().isoformat(timespec='seconds')
+    }).encode())
+
+    return zip_path
+
+
+# Read a workbook straight from its zip member, without extracting it to disk
+def read_spec_workbook(zfile, file_name):
+
+    # The workbooks may sit at the root of the zip or inside a folder
+    member = [name for name in zfile.namelist() if os.path.basename(name) == file_name]
+    if not member:
+        raise KeyError(f'{file_name} is not in the AHRQ spec zip.')
+
+    return BytesIO(zfile.read(member[0]))
 
 
 # Use the technical specifications to identify the inclusion and exclusion sheets of each PQE
 ####################################################################
 
-# Define a function to loop through all relevant sheets for each PQE
-def pqe_sheet_consolidation(pqe, file_name, sheet_list, dx_type):
-  
-    temp_df = pd.DataFrame()
-    
-    # looping function to get the diagnoses out of each sheet
+pqe_sheet_specs = [
+  dict(pqe='Dental Visit',
+       file_name='PQE_01_Visits_for_Dental_Conditions.xlsx',
+       sheet_list=['DENTALVISIT'],
+       dx_type='Inclusion'),
+  dict(pqe='Dental Visit',
+       file_name='PQE_01_Visits_for_Dental_Conditions.xlsx',
+       sheet_list=['TRAUMATOFACE'],
+       dx_type='Exclusion'),
+  dict(pqe='Chronic ASC',
+       file_name='PQE_02_Visits_for_Chronic_Conditions.xlsx',
+       sheet_list=['ASTHMA', 'COPD', 'HEARTFAILURE', 'DMSTCX', 'CKD', 'LOWERRESPINFECTION'],
+       dx_type='Inclusion'),
+  dict(pqe='Acute ASC',
+       file_name='PQE_03_Visits_for_Acute_Conditions.xlsx',
+       sheet_list=['UTI_NONCX', 'UPPERRESPINFECTION', 'INFLUENZA', 'CELLULITIS'],
+       dx_type='Inclusion'),
+  dict(pqe='Acute ASC',
+       file_name='PQE_03_Visits_for_Acute_Conditions.xlsx',
+       sheet_list=['IMMUNOCOMPROMISED', 'DIABETES', 'QE03EXC_UTI', 'QE03EXC_UTM'],
+       dx_type='Exclusion'),
+  dict(pqe='Asthma',
+       file_name='PQE_04_Visits_for_Asthma.xlsx',
+       sheet_list=['ASTHMA', 'QE4BRONCHITIS'],
+       dx_type='Inclusion'),
+  dict(pqe='Asthma',
+       file_name='PQE_04_Visits_for_Asthma.xlsx',
+       sheet_list=['CYSTICFIBROSIS', 'RESPIRATORYANOMALIES', 'QE4EXC_PNEUMONIA'],
+       dx_type='Exclusion'),
+  dict(pqe='Back Pain',
+       file_name='PQE_05_Visits_for_BackPain.xlsx',
+       sheet_list=['BACKPAIN'],
+       dx_type='Inclusion'),
+  dict(pqe='Back Pain',
+       file_name='PQE_05_Visits_for_BackPain.xlsx',
+       sheet_list=['BPEXCLUDEUTI', 'BPEXCLUDEFEVER', 'BPEXCLUDECES'],
+       dx_type='Exclusion'),
+  dict(pqe='Back Pain',
+       file_name='ED_PQI_Appendix_A.xlsx',
+       sheet_list=['APPENDIX A'],
+       dx_type='Exclusion'),
+  dict(pqe='Back Pain',
+       file_name='ED_PQI_Appendix_B.xlsx',
+       sheet_list=['APPENDIX B '],
+       dx_type='Exclusion'),
+]
+
+
+
+# Read every requested sheet of a workbook in a single streaming pass
+####################################################################
+
+# Open the workbook once, read-only, and keep the non-empty values of the first and fourth
+# columns of each sheet (first column values, then fourth column values, as in the Excel tables)
+def read_workbook_codes(zip_path, file_name, sheet_list):
+
+    import openpyxl
+
+    with ZipFile(zip_path) as zfile:
+        workbook = openpyxl.load_workbook(read_spec_workbook(zfile, file_name), read_only=True, data_only=True)
+
+    workbook_codes = {}
+    try:
+        for sheet in sheet_list:
+            first_column, fourth_column = [], []
+
+            # Skip the title row and the header row
+            for row in workbook[sheet].iter_rows(min_row=3, max_col=4, values_only=True):
+                if len(row) > 0 and row[0] is not None:
+                    first_column.append(row[0])
+                if len(row) > 3 and row[3] is not None:
+                    fourth_column.append(row[3])
+
+            workbook_codes[sheet] = first_column + fourth_column
+    finally:
+        workbook.close()
+
+    return workbook_codes
+
+
+# The sheets needed from each workbook, across its inclusion and exclusion specs.
+# Returns {file_name: [sheets]}.
+def spec_workbook_sheets(sheet_specs):
+
+    workbook_sheets = {}
+    for spec in sheet_specs:
+        sheets = workbook_sheets.setdefault(spec['file_name'], [])
+        sheets += [sheet for sheet in spec['sheet_list'] if sheet not in sheets]
+
+    return workbook_sheets
+
+
+# Read the given sheets of each workbook, each workbook opened once, in parallel across workbooks.
+# Returns {file_name: {sheet: [dx codes]}}.
+def read_spec_workbooks(zip_path, workbook_sheets, workers=None):
+
+    workers = min(workers or os.cpu_count() or 1, len(workbook_sheets))
+    if workers <= 1:
+        return {file_name: read_workbook_codes(zip_path, file_name, sheets)
+                for file_name, sheets in workbook_sheets.items()}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        workbook_codes = executor.map(read_workbook_codes,
+                                      [zip_path] * len(workbook_sheets),
+                                      workbook_sheets.keys(),
+                                      workbook_sheets.values())
+        return dict(zip(workbook_sheets.keys(), workbook_codes))
+
+
+
+# Re-parse only the sheets whose content changed since a previously built spec version
+####################################################################
+
+spreadsheet_ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+package_rels_ns = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+office_rels_ns = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+
+# Content fingerprint of each requested sheet of a workbook. The sheet XML is read with the C
+# XML parser (much cheaper than openpyxl), shared strings are resolved, and the cell references
+# and values are hashed, so a sheet keeps its fingerprint when only other sheets change.
+def sheet_fingerprints(workbook_file, sheet_list):
+
+    with ZipFile(workbook_file) as workbook:
+        members = set(workbook.namelist())
+
+        # Map the sheet names to their XML parts through the workbook relationships
+        rels = ElementTree.fromstring(workbook.read('xl/_rels/workbook.xml.rels'))
+        targets = {rel.get('Id'): rel.get('Target') for rel in rels.iter(f'{package_rels_ns}Relationship')}
+        sheet_parts = {}
+        for sheet in ElementTree.fromstring(workbook.read('xl/workbook.xml')).iter(f'{spreadsheet_ns}sheet'):
+            target = targets[sheet.get(f'{office_rels_ns}id')]
+            sheet_parts[sheet.get('name')] = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+
+        shared_strings = []
+        if 'xl/sharedStrings.xml' in members:
+            for item in ElementTree.fromstring(workbook.read('xl/sharedStrings.xml')).iter(f'{spreadsheet_ns}si'):
+                shared_strings.append(''.join(text.text or '' for text in item.iter(f'{spreadsheet_ns}t')))
+
+        fingerprints = {}
+        for sheet in sheet_list:
+            sheet_hash = hashlib.sha256()
+            with workbook.open(sheet_parts[sheet]) as sheet_xml:
+                for _, cell in ElementTree.iterparse(sheet_xml):
+                    if cell.tag != f'{spreadsheet_ns}c':
+                        continue
+                    value = ''.join(text.text or '' for text in cell.iter() if text.tag in (f'{spreadsheet_ns}v', f'{spreadsheet_ns}t'))
+                    if cell.get('t') == 's':
+                        value = shared_strings[int(value)]
+                    sheet_hash.update(f"{cell.get('r')}\t{value}\n".encode())
+                    cell.clear()
+            fingerprints[sheet] = sheet_hash.hexdigest()
+
+    return fingerprints
+
+
+# Read the spec workbooks, re-using the parsed codes of any sheet whose fingerprint was seen in a
+# previous build (sheets/<fingerprint>.json in the cache) and parsing only the others. The
+# fingerprints of the version are recorded in manifests/<version>.json.
+def read_spec_workbooks_incremental(zip_path, workbook_sheets, version=spec_version, cache_dir=cache_dir, workers=None):
+
+    manifest = {}
+    workbook_codes = {}
+    changed_sheets = {}
+
+    with ZipFile(zip_path) as zfile:
+        for file_name, sheets in workbook_sheets.items():
+            manifest[file_name] = sheet_fingerprints(read_spec_workbook(zfile, file_name), sheets)
+            workbook_codes[file_name] = {}
+
+            for sheet, fingerprint in manifest[file_name].items():
+                sheet_file = os.path.join(cache_dir, 'sheets', f'{fingerprint}.json')
+                if os.path.exists(sheet_file):
+                    with open(sheet_file) as file:
+                        workbook_codes[file_name][sheet] = json.load(file)
+                else:
+                    changed_sheets.setdefault(file_name, []).append(sheet)
+
+    parsed_codes = read_spec_workbooks(zip_path, changed_sheets, workers) if changed_sheets else {}
+    for file_name, sheet_codes in parsed_codes.items():
+        for sheet, codes in sheet_codes.items():
+            write_atomic(os.path.join(cache_dir, 'sheets', f'{manifest[file_name][sheet]}.json'), json.dumps(codes).encode())
+        workbook_codes[file_name].update(sheet_codes)
+
+    write_atomic(os.path.join(cache_dir, 'manifests', f'{version}.json'), json.dumps(manifest).encode())
+
+    # Keep the workbook and sheet order of workbook_sheets
+    return {file_name: {sheet: workbook_codes[file_name][sheet] for sheet in sheets}
+            for file_name, sheets in workbook_sheets.items()}
+
+
+# Define a function to label the diagnoses of all relevant sheets for each PQE
+def pqe_sheet_consolidation(pqe, file_name, sheet_list, dx_type, workbook_codes):
+
+    import pandas as pd
+
+    dx_codes = []
+    categories = []
+
+    # Gather the diagnoses of each sheet, labelled with the sheet as the category
     for sheet in sheet_list:
+        sheet_codes = workbook_codes[file_name][sheet]
+        dx_codes += sheet_codes
+        categories += [sheet] * len(sheet_codes)
+
+    return pd.DataFrame({'dx_code': dx_codes, 'pqe': pqe, 'type': dx_type, 'category': categories})
+
+
+
+# Format the dx codes to include decimals and strip any unnecessary whitespace from the category field
+def format_pqe_codes(pqe_codes):
+
+    import numpy as np
+
+    pqe_codes['dx_code'] = np.where(
+      pqe_codes['dx_code'].str.len() > 3,
+      pqe_codes['dx_code'].str.slice(start=0, stop=3)+'.'+pqe_codes['dx_code'].str.slice(start=3),
+      pqe_codes['dx_code']
+    )
+
+    pqe_codes['category'] = pqe_codes['category'].str.strip()
+
+    return pqe_codes
+
+
+
+# Report the codes added and removed since the previous spec version
+####################################################################
+
+# Most recent spec version built before the given one, from the cached manifests
+def previous_spec_version(version=spec_version, cache_dir=cache_dir):
+
+    manifest_dir = os.path.join(cache_dir, 'manifests')
+    versions = [file_name[:-len('.json')] for file_name in os.listdir(manifest_dir)] if os.path.isdir(manifest_dir) else []
+    versions = [other for other in versions if other < version]
+
+    return max(versions) if versions else None
+
+
+# Codes added and removed per PQE, type and category between two built spec versions. Only the
+# sheets whose fingerprints differ between the two manifests are compared.
+def diff_spec_versions(old_version, new_version, sheet_specs=pqe_sheet_specs, cache_dir=cache_dir):
+
+    import pandas as pd
+
+    manifests = {}
+    for version in [old_version, new_version]:
+        with open(os.path.join(cache_dir, 'manifests', f'{version}.json')) as file:
+            manifests[version] = json.load(file)
+
+    changes = []
+    for spec in sheet_specs:
+        for sheet in spec['sheet_list']:
+            fingerprints = [manifests[version].get(spec['file_name'], {}).get(sheet) for version in [old_version, new_version]]
+            if fingerprints[0] == fingerprints[1]:
+                continue
+
+            # A sheet that is missing from one version contributes no codes to it
+            versions_codes = []
+            for fingerprint in fingerprints:
+                sheet_codes = []
+                if fingerprint is not None:
+                    with open(os.path.join(cache_dir, 'sheets', f'{fingerprint}.json')) as file:
+                        sheet_codes = json.load(file)
+                versions_codes.append(set(sheet_codes))
+
+            for change, codes in [('Added', versions_codes[1] - versions_codes[0]), ('Removed', versions_codes[0] - versions_codes[1])]:
+                changes += [{'dx_code': code, 'pqe': spec['pqe'], 'type': spec['dx_type'], 'category': sheet, 'change': change}
+                            for code in sorted(codes)]
+
+    pqe_code_changes = pd.DataFrame(changes, columns=['dx_code', 'pqe', 'type', 'category', 'change'])
+
+    return format_pqe_codes(pqe_code_changes)
+
+
+
+# Encode ICD-10-CM codes as fixed-width integers
+####################################################################
+
+# An undotted ICD-10-CM code has at most 7 characters from 0-9 and A-Z. Each character is a
+# base-37 digit (0 is padding after the end of the code, 1-10 are 0-9, 11-36 are A-Z), so every
+# code packs into an int64 below 37**7, and integer order matches the codes' text order.
+dx_code_width = 7
+
+
+# Place values of the 7 digits, the digit value of each byte (-1 if not allowed), and the byte
+# of each digit value. Built on first use rather than at import.
+@functools.lru_cache(maxsize=None)
+def dx_code_tables():
+
+    import numpy as np
+
+    dx_code_powers = 37 ** np.arange(dx_code_width - 1, -1, -1, dtype=np.int64)
+
+    dx_char_values = np.full(256, -1, dtype=np.int64)
+    dx_char_values[0] = 0
+    dx_char_values[np.frombuffer(b'0123456789', dtype=np.uint8)] = np.arange(1, 11)
+    dx_char_values[np.frombuffer(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', dtype=np.uint8)] = np.arange(11, 37)
+    dx_char_values[np.frombuffer(b'abcdefghijklmnopqrstuvwxyz', dtype=np.uint8)] = np.arange(11, 37)
+
+    dx_value_chars = np.frombuffer(b'\x000123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ', dtype=np.uint8)
+
+    return dx_code_powers, dx_char_values, dx_value_chars
+
+
+# Normalize dx codes to the undotted, upper-case ICD-10-CM form (at most 7 characters).
+# Values that cannot be an ICD-10-CM code are returned as an empty string, which never matches.
+def normalize_dx_codes(dx_codes):
+
+    import pandas as pd
+
+    dx_codes = pd.Series(dx_codes, dtype='object').astype(str)
+    dx_codes = dx_codes.str.replace('.', '', regex=False).str.strip().str.upper()
+
+    return dx_codes.where(dx_codes.str.fullmatch(r'[A-Z0-9]{1,7}'), '')
+
+
+# Pack the character values of undotted codes, an (n, 7) array, into integers; -1 when invalid
+def pack_dx_chars(chars):
+
+    import numpy as np
+
+    dx_code_powers, dx_char_values, _ = dx_code_tables()
+    values = dx_char_values[chars]
+
+    # Every character must be valid, the code non-empty, and the padding only at the end
+    padding = values == 0
+    valid = (values >= 0).all(axis=1) & ~padding[:, 0] & ~(padding[:, :-1] & ~padding[:, 1:]).any(axis=1)
+
+    return np.where(valid, values @ dx_code_powers, -1)
+
+
+# Factorize dx codes and encode their distinct values. Returns the labels (-1 for missing values)
+# and the encoded distinct values followed by a trailing -1, so encoded[labels] encodes the input.
+# Plain codes are encoded on their bytes in bulk; only values that need more cleanup (such as
+# surrounding whitespace) go through the string normalization.
+def encode_distinct_dx_codes(dx_codes):
+
+    import numpy as np
+    import pandas as pd
+
+    labels, distinct_codes = pd.factorize(np.asarray(dx_codes, dtype=object))
+    distinct_codes = np.asarray(distinct_codes, dtype=object)
+    encoded = np.full(len(distinct_codes) + 1, -1, dtype=np.int64)
+    pending = np.arange(len(distinct_codes))
+
+    try:
+        chars = distinct_codes.astype(f'S{dx_code_width + 2}').view(np.uint8).reshape(-1, dx_code_width + 2).copy()
+    except UnicodeEncodeError:
+        chars = None
+
+    if chars is not None:
+        # Drop the decimal point after the three-character category
+        dotted = chars[:, 3] == ord('.')
+        chars[dotted, 3:-1] = chars[dotted, 4:]
+        chars[dotted, -1] = 0
+
+        fits = (chars[:, dx_code_width:] == 0).all(axis=1)
+        encoded[pending] = np.where(fits, pack_dx_chars(chars[:, :dx_code_width]), -1)
+        pending = pending[encoded[pending] == -1]
+
+    if len(pending) > 0:
+        normalized = normalize_dx_codes(distinct_codes[pending]).to_numpy(dtype=f'S{dx_code_width}')
+        encoded[pending] = pack_dx_chars(normalized.view(np.uint8).reshape(-1, dx_code_width))
+
+    return labels, encoded
+
+
+# Encode dotted or undotted dx codes as int64; missing values and non-codes become -1.
+# Claim extracts repeat the same few thousand codes, so only the distinct values are encoded and
+# the result is broadcast back through the factorized labels.
+def encode_dx_codes(dx_codes):
+
+    labels, encoded = encode_distinct_dx_codes(dx_codes)
+
+    return encoded[labels]
+
+
+# Decode integer dx codes back to text, with the decimal point after the category when dotted
+def decode_dx_codes(encoded, dotted=True):
+
+    import numpy as np
+    import pandas as pd
+
+    dx_code_powers, _, dx_value_chars = dx_code_tables()
+    encoded = np.asarray(encoded, dtype=np.int64)
+    chars = dx_value_chars[(np.maximum(encoded, 0)[:, None] // dx_code_powers) % 37]
+    dx_codes = pd.Series(chars.view(f'S{dx_code_width}').ravel().astype(str), dtype='object')
+
+    if dotted:
+        dx_codes = dx_codes.where(dx_codes.str.len() <= 3, dx_codes.str.slice(stop=3) + '.' + dx_codes.str.slice(start=3))
+
+    return dx_codes.where(encoded >= 0, None).to_numpy()
+
+
+
+# Compile the PQE codes into a matcher for classifying claim diagnosis codes
+####################################################################
+
+class PqeMatcher:
+
+    def __init__(self, pqe_codes):
+
+        import numpy as np
+        import pandas as pd
+
+        # Keep the PQEs in the order they were defined
+        self.pqes = list(pd.unique(pqe_codes['pqe']))
+        codes = pqe_codes['dx_int'].to_numpy() if 'dx_int' in pqe_codes else encode_dx_codes(pqe_codes['dx_code'])
+
+        # Spec rows whose code cannot be encoded (-1) would otherwise match every missing, blank
+        # or invalid claim code
+        valid = codes >= 0
+        pqe_codes, codes = pqe_codes[valid], codes[valid]
+
+        # Sorted int64 array of the distinct codes; a claim code is located with a binary search
+        self.codes, code_position = np.unique(codes, return_inverse=True)
+        pqe_position = pd.Categorical(pqe_codes['pqe'], categories=self.pqes).codes
+
+        # One flag row per distinct code, plus a trailing all-False row that unmatched codes (-1) land on
+        self.inclusion = np.zeros((len(self.codes)+1, len(self.pqes)), dtype=bool)
+        self.exclusion = np.zeros((len(self.codes)+1, len(self.pqes)), dtype=bool)
+
+        is_exclusion = (pqe_codes['type'] == 'Exclusion').to_numpy()
+        self.inclusion[code_position[~is_exclusion], pqe_position[~is_exclusion]] = True
+        self.exclusion[code_position[is_exclusion], pqe_position[is_exclusion]] = True
+
+        # Inclusion flags per inclusion category, named 'pqe|category', for rates by category
+        category_names = (pqe_codes['pqe'].astype(str) + '|' + pqe_codes['category'].astype(str)).to_numpy()
+        self.categories = list(pd.unique(category_names[~is_exclusion]))
+        category_position = pd.Categorical(category_names[~is_exclusion], categories=self.categories).codes
+
+        self.category_inclusion = np.zeros((len(self.codes)+1, len(self.categories)), dtype=bool)
+        self.category_inclusion[code_position[~is_exclusion], category_position] = True
+
+
+    # Position of each encoded code in the sorted code array, or -1 when absent or not a valid code (-1)
+    def locate(self, encoded_codes):
+
+        import numpy as np
+
+        encoded_codes = np.asarray(encoded_codes, dtype=np.int64)
+        if len(self.codes) == 0:
+            return np.full(len(encoded_codes), -1)
+
+        position = np.searchsorted(self.codes, encoded_codes)
+        position = np.minimum(position, len(self.codes)-1)
+        found = (self.codes[position] == encoded_codes) & (encoded_codes >= 0)
+
+        return np.where(found, position, -1)
+
+
+    # Flag table row of each dx code, given as text or already encoded as int64 by encode_dx_codes
+    def positions(self, dx_codes):
+
+        import numpy as np
+
+        dx_codes = np.asarray(dx_codes)
+        if dx_codes.dtype == np.int64:
+            return self.locate(dx_codes)
+
+        # Search only the distinct codes, then broadcast back through the labels
+        labels, encoded = encode_distinct_dx_codes(dx_codes)
+        return self.locate(encoded)[labels]
+
+
+    # Inclusion and exclusion flags (rows = input codes, columns = self.pqes)
+    def lookup(self, dx_codes):
+
+        position = self.positions(dx_codes)
+
+        return self.inclusion[position], self.exclusion[position]
+
+
+    # PQE (column of self.pqes) of each inclusion category in self.categories
+    def category_pqes(self):
+
+        return [self.pqes.index(category.split('|')[0]) for category in self.categories]
+
+
+    # Qualifying PQE flags, where an exclusion overrides an inclusion for the same PQE
+    def classify(self, dx_codes):
+
+        import pandas as pd
+
+        inclusion, exclusion = self.lookup(dx_codes)
+        index = dx_codes.index if isinstance(dx_codes, pd.Series) else None
+
+        return pd.DataFrame(inclusion & ~exclusion, columns=self.pqes, index=index)
+
+
+    # Matcher over the memory-mapped arrays of a code set artifact (see write_pqe_artifact)
+    @classmethod
+    def from_artifact(cls, artifact_dir):
+
+        import numpy as np
+
+        # Resolve the symlink once, so every array comes from the same build
+        artifact_dir = os.path.realpath(artifact_dir)
+        with open(os.path.join(artifact_dir, 'dictionary.json')) as file:
+            dictionary = json.load(file)
+
+        matcher = cls.__new__(cls)
+        matcher.pqes = dictionary['pqe']
+        matcher.categories = dictionary['matcher_categories']
+        for name in ['codes', 'inclusion', 'exclusion', 'category_inclusion']:
+            setattr(matcher, name, np.load(os.path.join(artifact_dir, f'matcher_{name}.npy'), mmap_mode='r'))
+
+        return matcher
+
+
+
+# Score claim files in bounded-size chunks
+####################################################################
+
+# Diagnosis columns such as dx1 ... dx25, DX_01 or diag_cd_1
+dx_column_pattern = r'(?i)(dx|diag)\D*\d+'
+
+
+# Column names of a CSV or Parquet claims file
+def claim_file_columns(file_path):
+
+    if file_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(file_path).schema_arrow.names
+
+    import pandas as pd
+    return pd.read_csv(file_path, nrows=0).columns.tolist()
+
+
+# Read a CSV or Parquet claims file as DataFrames of at most chunksize rows
+def read_claim_chunks(file_path, columns, chunksize):
+
+    if file_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        import pandas as pd
+        yield from pd.read_csv(file_path, usecols=columns, dtype=str, chunksize=chunksize)
+
+
+# Arrow schema of scored claims: the claim columns as typed in a Parquet input file (CSV input is
+# read as text), and an int8 column per flag. Built once, so a claim column that is all null in
+# the first chunk does not fix its type for the whole file.
+def scored_claim_schema(input_path, id_columns, flag_columns):
+
+    import pyarrow as pa
+
+    if input_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        input_schema = pq.ParquetFile(input_path).schema_arrow
+        id_fields = [input_schema.field(column) for column in id_columns]
+    else:
+        id_fields = [pa.field(column, pa.string()) for column in id_columns]
+
+    return pa.schema(id_fields + [pa.field(column, pa.int8()) for column in flag_columns])
+
+
+# Append a chunk of scored claims to a CSV or Parquet output file. Parquet chunks are cast to
+# schema, or to the schema of the first chunk when none is given.
+class ScoredClaimWriter:
+
+    def __init__(self, file_path, schema=None):
+        self.file_path = file_path
+        self.schema = schema
+        self.parquet_writer = None
+        self.rows = 0
+
+    def write(self, scored_chunk):
+
+        if self.file_path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(scored_chunk, schema=self.schema, preserve_index=False)
+            if self.parquet_writer is None:
+                self.schema = table.schema
+                self.parquet_writer = pq.ParquetWriter(self.file_path, table.schema)
+            self.parquet_writer.write_table(table)
+        else:
+            scored_chunk.to_csv(self.file_path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0, index=False)
+
+        self.rows += len(scored_chunk)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+# Per-claim PQE flags for a chunk of claims. A claim is flagged for a PQE when any of its
+# diagnoses (or only the principal, first dx column, when principal_only) is an inclusion
+# code and none of its diagnoses is an exclusion code for that PQE. With categories, a
+# 'pqe|category' flag is added per inclusion category on the same rule.
+def score_claim_chunk(claims, matcher, dx_columns, principal_only=False, categories=False):
+
+    import numpy as np
+    import pandas as pd
+
+    n_claims, n_positions = len(claims), len(dx_columns)
+    position = matcher.positions(claims[dx_columns].to_numpy(dtype=object).ravel())
+    position = position.reshape(n_claims, n_positions)
+    inclusion_position = position[:, :1] if principal_only else position
+
+    claim_exclusion = matcher.exclusion[position].any(axis=1)
+    claim_flags = matcher.inclusion[inclusion_position].any(axis=1) & ~claim_exclusion
+    flags = pd.DataFrame(claim_flags.astype(np.int8), columns=matcher.pqes, index=claims.index)
+
+    if categories:
+        category_flags = matcher.category_inclusion[inclusion_position].any(axis=1) & ~claim_exclusion[:, matcher.category_pqes()]
+        category_flags = pd.DataFrame(category_flags.astype(np.int8), columns=matcher.categories, index=claims.index)
+        flags = pd.concat([flags, category_flags], axis=1)
+
+    return flags
+
+
+# Stream a claims file (CSV or Parquet) through the matcher, writing the non-diagnosis columns
+# (or id_columns) plus one 0/1 flag column per PQE (and per inclusion category, with categories)
+# to output_path (CSV or Parquet) chunk by chunk. Peak memory depends on chunksize, not on the
+# size of the input file.
+def score_claims_file(input_path, output_path, matcher=None, dx_columns=None, id_columns=None,
+                      chunksize=200_000, principal_only=False, categories=False):
+
+    import pandas as pd
+
+    matcher = matcher or load_pqe_matcher()
+    columns = claim_file_columns(input_path)
+
+    if dx_columns is None:
+        dx_columns = [column for column in columns if re.fullmatch(dx_column_pattern, column)]
+    if not dx_columns:
+        raise ValueError(f'No diagnosis columns found in {input_path}; pass dx_columns.')
+    if id_columns is None:
+        id_columns = [column for column in columns if column not in dx_columns]
+
+    schema = None
+    if output_path.endswith('.parquet'):
+        flag_columns = matcher.pqes + (matcher.categories if categories else [])
+        schema = scored_claim_schema(input_path, id_columns, flag_columns)
+
+    writer = ScoredClaimWriter(output_path, schema)
+    try:
+        for claims in read_claim_chunks(input_path, id_columns + dx_columns, chunksize):
+            flags = score_claim_chunk(claims, matcher, dx_columns, principal_only, categories)
+            writer.write(pd.concat([claims[id_columns], flags], axis=1))
+    finally:
+        writer.close()
+
+    return writer.rows
+
+
+
+# Aggregate flagged claims into PQE rates, slice by slice
+####################################################################
+
+# Flags as integers, and the month (YYYY-MM) of the claim date, e.g. for group_columns=['facility', 'month']
+def prepare_claim_flags(flagged_claims, flag_columns, date_column=None):
+
+    import numpy as np
+    import pandas as pd
+
+    flagged_claims = flagged_claims.astype({column: 'int64' for column in flag_columns})
+
+    # Each distinct month is formatted once, rather than every claim date; a missing date has no month
+    if date_column is not None:
+        month_codes, months = pd.factorize(pd.to_datetime(flagged_claims[date_column]).to_numpy().astype('datetime64[M]'))
+        month_labels = np.append(pd.DatetimeIndex(months).strftime('%Y-%m').to_numpy(dtype=object), np.nan)
+        flagged_claims = flagged_claims.assign(month=month_labels[month_codes])
+
+    return flagged_claims
+
+
+# Numerators (flag sums) and the denominator (claim count) of a set of claims, by group
+def aggregate_claim_flags(claims, group_columns, flag_columns):
+
+    claims = claims[group_columns + flag_columns].assign(claims=1)
+
+    if not group_columns:
+        return claims[flag_columns + ['claims']].sum().to_frame().T
+
+    return claims.groupby(group_columns, dropna=False, observed=True, sort=False)[flag_columns + ['claims']].sum().reset_index()
+
+
+# Add up partial aggregates (from aggregate_claim_flags) of the same groups
+def merge_claim_aggregates(partials, group_columns):
+
+    import pandas as pd
+
+    partials = pd.concat(partials, ignore_index=True)
+
+    if not group_columns:
+        return partials.sum().to_frame().T
+
+    return partials.groupby(group_columns, dropna=False, observed=True, sort=False).sum().reset_index()
+
+
+# Worker function: aggregate of the given row groups of a flagged claims Parquet file, read by
+# the worker itself so that only the small aggregate crosses the process boundary
+def aggregate_parquet_row_groups(file_path, row_groups, columns, group_columns, flag_columns, date_column):
+
+    import pyarrow.parquet as pq
+
+    flagged_claims = pq.ParquetFile(file_path).read_row_groups(row_groups, columns=columns).to_pandas()
+
+    return aggregate_claim_flags(prepare_claim_flags(flagged_claims, flag_columns, date_column), group_columns, flag_columns)
+
+
+# Consecutive row groups of a Parquet file, in slices of at least chunksize rows
+def parquet_row_group_slices(parquet_file, chunksize):
+
+    slices, row_groups, rows = [], [], 0
+    for row_group in range(parquet_file.num_row_groups):
+        row_groups.append(row_group)
+        rows += parquet_file.metadata.row_group(row_group).num_rows
+        if rows >= chunksize:
+            slices.append(row_groups)
+            row_groups, rows = [], 0
+
+    if row_groups:
+        slices.append(row_groups)
+
+    return slices
+
+
+# Rate aggregation over flagged claims (the output of score_claims_file). Each slice of claims
+# is aggregated on its own and the partial sums are added together, which is exact. Chunks
+# given to update() are aggregated in this process; the row groups of a Parquet file given to
+# update_from_file() are read and aggregated by a pool of worker processes.
+# The running totals are kept, so a new month of claims is added with update() without
+# recomputing history, and save()/load() persist them between runs.
+class PqeRateAggregator:
+
+    def __init__(self, group_columns, flag_columns=None, date_column=None, workers=None, matcher=None):
+
+        self.group_columns = list(group_columns)
+        self.flag_columns = flag_columns
+        self.date_column = date_column
+        self.workers = workers or os.cpu_count() or 1
+        self.totals = None
+        self.sources = []
+        self.executor = None
+        self.matcher = matcher
+
+
+    # PQE flags (and 'pqe|category' flags) of the claims, named after the built code set
+    def default_flag_columns(self, columns):
+
+        matcher = self.matcher or load_pqe_matcher()
+        measures = set(matcher.pqes) | set(matcher.categories)
+
+        return [column for column in columns if column in measures]
+
+
+    # Add partial aggregates to the totals
+    def merge(self, partials):
+
+        if self.totals is not None:
+            partials = partials + [self.totals]
+        self.totals = merge_claim_aggregates(partials, self.group_columns)
+
+
+    # Add a chunk of flagged claims to the totals
+    def update(self, flagged_claims):
+
+        if self.flag_columns is None:
+            self.flag_columns = self.default_flag_columns(flagged_claims.columns)
+
+        flagged_claims = prepare_claim_flags(flagged_claims, self.flag_columns, self.date_column)
+        self.merge([aggregate_claim_flags(flagged_claims, self.group_columns, self.flag_columns)])
+
+        return self
+
+
+    # Add a flagged claims file (CSV or Parquet), chunk by chunk. A file that was already added,
+    # with the same path, size and modification time, is skipped, so re-running an update does
+    # not count its claims twice; a new month written to the same path is still added.
+    # With several workers, the row groups of a Parquet file are read and aggregated in slices of
+    # about chunksize rows by the process pool; a CSV file is aggregated here as it is read.
+    def update_from_file(self, file_path, chunksize=500_000):
+
+        file_stat = os.stat(file_path)
+        source = (os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+        if source in self.sources:
+            return self
+
+        row_group_slices = []
+        if file_path.endswith('.parquet') and self.workers > 1:
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(file_path)
+            row_group_slices = parquet_row_group_slices(parquet_file, chunksize)
+
+        if len(row_group_slices) > 1:
+            file_columns = parquet_file.schema_arrow.names
+            if self.flag_columns is None:
+                self.flag_columns = self.default_flag_columns(file_columns)
+            columns = [column for column in file_columns
+                       if column in self.group_columns + self.flag_columns + [self.date_column]]
+
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            slice_count = len(row_group_slices)
+            self.merge(list(self.executor.map(aggregate_parquet_row_groups,
+                                              [file_path] * slice_count,
+                                              row_group_slices,
+                                              [columns] * slice_count,
+                                              [self.group_columns] * slice_count,
+                                              [self.flag_columns] * slice_count,
+                                              [self.date_column] * slice_count)))
+        else:
+            for flagged_claims in read_claim_chunks(file_path, None, chunksize):
+                self.update(flagged_claims)
+        self.sources.append(source)
+
+        return self
+
+
+    # Rates in long format: the group columns, pqe, category (empty for the PQE as a whole),
+    # numerator (flagged claims), denominator (all claims) and rate
+    def rates(self):
+
+        import pandas as pd
+
+        if self.totals is None:
+            return pd.DataFrame(columns=self.group_columns + ['pqe', 'category', 'numerator', 'denominator', 'rate'])
+
+        rates = self.totals.melt(id_vars=self.group_columns + ['claims'], value_vars=self.flag_columns,
+                                 var_name='measure', value_name='numerator')
+        measure = rates.pop('measure').str.split('|', n=1, expand=True).reindex(columns=[0, 1])
+        rates['pqe'] = measure[0]
+        rates['category'] = measure[1].fillna('')
+        rates['denominator'] = rates.pop('claims')
+        rates['rate'] = rates['numerator'] / rates['denominator']
+
+        return rates[self.group_columns + ['pqe', 'category', 'numerator', 'denominator', 'rate']]
+
+
+    def close(self):
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+    # Persist the totals and settings, to continue with the next month's claims later
+    def save(self, file_path):
+
+        self.close()
+        state = {key: value for key, value in self.__dict__.items() if key not in ('executor', 'matcher')}
+        write_atomic(file_path, pickle.dumps(state))
+
+
+    @classmethod
+    def load(cls, file_path, workers=None):
+
+        aggregator = cls.__new__(cls)
+        with open(file_path, 'rb') as file:
+            aggregator.__dict__.update(pickle.load(file), executor=None, matcher=None)
+        if workers is not None:
+            aggregator.workers = workers
+
+        return aggregator
+
+
+
+# Write the code set to a compact binary artifact that worker processes memory-map
+####################################################################
+
+# Default artifact location for a spec version
+def artifact_path(version=spec_version, cache_dir=cache_dir):
+
+    return os.path.join(cache_dir, 'artifacts', version)
+
+
+# The artifact is a directory of .npy arrays: the dx codes as int64 (see encode_dx_codes), the pqe, type
+# and category columns as dictionary codes (labels in dictionary.json), and the matcher's
+# sorted code array and flag tables. Every array can be memory-mapped read-only, so any number
+# of processes share one copy through the page cache.
+# Each build is written to its own <artifact_dir>.build-<id> directory, and artifact_dir is a
+# symlink to the current build, swapped atomically once the build is complete.
+def write_pqe_artifact(pqe_codes, matcher, artifact_dir):
+
+    import numpy as np
+    import pandas as pd
+
+    temp_dir = f'{artifact_dir}.build-{uuid.uuid4().hex}'
+    os.makedirs(temp_dir)
+
+    dictionary = {'rows': len(pqe_codes)}
+    np.save(os.path.join(temp_dir, 'dx_int.npy'), pqe_codes['dx_int'].to_numpy(dtype=np.int64))
+
+    for column in ['pqe', 'type', 'category']:
+        codes, labels = pd.factorize(pqe_codes[column])
+        dictionary[column] = labels.tolist()
+        np.save(os.path.join(temp_dir, f'{column}.npy'), codes.astype(np.int16))
+
+    # The matcher lists its PQEs in the same first-appearance order as the factorized labels
+    dictionary['matcher_categories'] = matcher.categories
+    for name in ['codes', 'inclusion', 'exclusion', 'category_inclusion']:
+        np.save(os.path.join(temp_dir, f'matcher_{name}.npy'), getattr(matcher, name))
+
+    with open(os.path.join(temp_dir, 'dictionary.json'), 'w') as file:
+        json.dump(dictionary, file)
+
+    # Point artifact_dir at the finished build by replacing the symlink, so a reader sees either
+    # the previous build or this one, never a missing or partly written artifact
+    previous_build = os.readlink(artifact_dir) if os.path.islink(artifact_dir) else None
+    link_path = f'{temp_dir}.link'
+    os.symlink(os.path.basename(temp_dir), link_path)
+    if os.path.isdir(artifact_dir) and not os.path.islink(artifact_dir):
+        # An artifact written as a plain directory, before builds were versioned
+        os.replace(artifact_dir, f'{temp_dir}.old')
+    os.replace(link_path, artifact_dir)
+
+    # Remove older builds. The previous one is kept until the next build, for readers that
+    # resolved the symlink just before the swap.
+    artifact_parent, artifact_name = os.path.split(os.path.abspath(artifact_dir))
+    for file_name in os.listdir(artifact_parent):
+        if file_name.startswith(f'{artifact_name}.build-') and file_name not in (os.path.basename(temp_dir), previous_build):
+            build_path = os.path.join(artifact_parent, file_name)
+            if os.path.islink(build_path):
+                os.remove(build_path)
+            else:
+                shutil.rmtree(build_path, ignore_errors=True)
+
+    return artifact_dir
+
+
+# Load the code set from an artifact. The dx_int column and the codes of the categorical pqe,
+# type and category columns are memory-mapped; only the dx_code text is decoded into the process.
+def load_pqe_codes(artifact_dir):
+
+    import numpy as np
+    import pandas as pd
+
+    # Resolve the symlink once, so every array comes from the same build
+    artifact_dir = os.path.realpath(artifact_dir)
+    with open(os.path.join(artifact_dir, 'dictionary.json')) as file:
+        dictionary = json.load(file)
+
+    dx_int = np.load(os.path.join(artifact_dir, 'dx_int.npy'), mmap_mode='r')
+    columns = {'dx_code': decode_dx_codes(dx_int)}
+    for column in ['pqe', 'type', 'category']:
+        codes = np.load(os.path.join(artifact_dir, f'{column}.npy'), mmap_mode='r')
+        columns[column] = pd.Categorical.from_codes(codes, dictionary[column])
+    columns['dx_int'] = dx_int
+
+    return pd.DataFrame(columns, copy=False)
+
+
+
+# Build and load entry points, and the command line
+####################################################################
+
+# Build the pqe_codes table of a spec version from its cached (or downloaded) zip
+def build_pqe_codes(version=spec_version, cache_dir=cache_dir, offline=offline, workers=None):
+
+    import pandas as pd
+
+    spec_zip_path = fetch_spec_zip(version, cache_dir, offline)
+    workbook_codes = read_spec_workbooks_incremental(spec_zip_path, spec_workbook_sheets(pqe_sheet_specs),
+                                                     version, cache_dir, workers)
+
+    # Consolidate the sheets of every PQE
+    pqe_tables = [pqe_sheet_consolidation(**spec, workbook_codes=workbook_codes) for spec in pqe_sheet_specs]
+    pqe_codes = pd.concat(pqe_tables, axis=0).reset_index(drop=True)
+
+    pqe_codes = format_pqe_codes(pqe_codes)
+    pqe_codes['dx_int'] = encode_dx_codes(pqe_codes['dx_code'])
+
+    return pqe_codes
+
+
+# Build the code set, write its artifact, and emit the changes from the previously built version
+# (diffs/<old version>_<new version>.json in the cache), e.g. for downstream caches to invalidate
+# only the PQEs that changed
+def build(version=spec_version, cache_dir=cache_dir, offline=offline, workers=None):
+
+    pqe_codes = build_pqe_codes(version, cache_dir, offline, workers)
+    write_pqe_artifact(pqe_codes, PqeMatcher(pqe_codes), artifact_path(version, cache_dir))
+
+    previous_version = previous_spec_version(version, cache_dir)
+    if previous_version is not None:
+        pqe_code_changes = diff_spec_versions(previous_version, version, cache_dir=cache_dir)
+        write_atomic(os.path.join(cache_dir, 'diffs', f'{previous_version}_{version}.json'),
+                     pqe_code_changes.to_json(orient='records').encode())
+        print(f'{len(pqe_code_changes)} code changes from {previous_version} to {version}:')
+        print(pqe_code_changes.groupby(['pqe', 'type', 'category', 'change']).size())
+
+    return pqe_codes
+
+
+# Matcher over the prebuilt artifact of a spec version. Only numpy is imported, and the network
+# is never used; run the build first.
+def load_pqe_matcher(version=spec_version, cache_dir=cache_dir):
+
+    artifact_dir = artifact_path(version, cache_dir)
+    if not os.path.isdir(artifact_dir):
+        raise FileNotFoundError(f'No PQE code set artifact for {version} at {artifact_dir}; run the build first.')
+
+    return PqeMatcher.from_artifact(artifact_dir)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Build the AHRQ ED PQI code set and score ED claims against it.')
+    parser.add_argument('--version', default=spec_version, help=f'AHRQ spec version (default {spec_version})')
+    parser.add_argument('--cache-dir', default=cache_dir, help=f'spec and artifact cache (default {cache_dir})')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='build the code set artifact (the default command)')
+    build_parser.add_argument('--offline', action='store_true', default=offline, help='never download the spec zip')
+    build_parser.add_argument('--workers', type=int, help='workbook parsing processes (default: one per CPU)')
+
+    score_parser = subparsers.add_parser('score', help='write per-claim PQE flags for a CSV or Parquet claims file')
+    score_parser.add_argument('input_path')
+    score_parser.add_argument('output_path')
+    score_parser.add_argument('--dx-columns', nargs='+', help='diagnosis columns (default: dx1, DX_01, diag_cd_1, ...)')
+    score_parser.add_argument('--chunksize', type=int, default=200_000)
+    score_parser.add_argument('--principal-only', action='store_true', help='take inclusions from the first dx column only')
+    score_parser.add_argument('--categories', action='store_true', help="add a 'pqe|category' flag per inclusion category")
+
+    rates_parser = subparsers.add_parser('rates', help='aggregate scored claims files into PQE rates')
+    rates_parser.add_argument('input_paths', nargs='+', help='scored claims files (CSV or Parquet)')
+    rates_parser.add_argument('output_path', help='rates CSV')
+    rates_parser.add_argument('--group-columns', nargs='*', help='e.g. facility_id month sex age_group')
+    rates_parser.add_argument('--date-column', help="claim date column, to group by 'month'")
+    rates_parser.add_argument('--workers', type=int, help='aggregation processes (default: one per CPU)')
+    rates_parser.add_argument('--state', help='totals file to continue from and update, for incremental runs')
+
+    diff_parser = subparsers.add_parser('diff', help='list the codes added and removed between two built versions')
+    diff_parser.add_argument('old_version')
+    diff_parser.add_argument('new_version')
+    diff_parser.add_argument('--output', help='write the changes as JSON records to this file')
+
+    args = parser.parse_args(argv)
+
+    if args.command in (None, 'build'):
+        pqe_codes = build(args.version, args.cache_dir, getattr(args, 'offline', offline), getattr(args, 'workers', None))
+        print(f'Built {len(pqe_codes)} PQE codes for {args.version} at {artifact_path(args.version, args.cache_dir)}')
+
+    elif args.command == 'score':
+        claims = score_claims_file(args.input_path, args.output_path,
+                                   matcher=load_pqe_matcher(args.version, args.cache_dir),
+                                   dx_columns=args.dx_columns, chunksize=args.chunksize,
+                                   principal_only=args.principal_only, categories=args.categories)
+        print(f'Scored {claims} claims into {args.output_path}')
+
+    elif args.command == 'rates':
+        if args.state and os.path.exists(args.state):
+            aggregator = PqeRateAggregator.load(args.state, workers=args.workers)
+
+            # The saved totals fix the grouping; a different one cannot be applied to them
+            for option, given, saved in [('--group-columns', args.group_columns, aggregator.group_columns),
+                                         ('--date-column', args.date_column, aggregator.date_column)]:
+                if given is not None and given != saved:
+                    parser.error(f'{option} {given} differs from {saved} saved in {args.state}; '
+                                 f'use a new --state file to change it')
+        else:
+            aggregator = PqeRateAggregator(args.group_columns or [], date_column=args.date_column, workers=args.workers,
+                                           matcher=load_pqe_matcher(args.version, args.cache_dir))
+        try:
+            for input_path in args.input_paths:
+                aggregator.update_from_file(input_path)
+        finally:
+            aggregator.close()
+
+        if args.state:
+            aggregator.save(args.state)
+        aggregator.rates().to_csv(args.output_path, index=False)
+        print(f'Wrote PQE rates for {len(aggregator.sources)} claims files to {args.output_path}')
+
+    elif args.command == 'diff':
+        pqe_code_changes = diff_spec_versions(args.old_version, args.new_version, cache_dir=args.cache_dir)
+        if args.output:
+            pqe_code_changes.to_json(args.output, orient='records')
+        print(pqe_code_changes.to_string(index=False))
+
 
-        sheet_inclusion = pd.read_excel(temp_dir.name+'/'+file_name,
-                                        sheet_name=sheet,
-                                        engine='openpyxl',
-                                        skiprows = 1)
-
-        # Create a list out of the first and third colums
-        sheet_inclusion_list = sheet_inclusion.iloc[:,0].tolist() + sheet_inclusion.iloc[:,3].tolist()
-
-        # Remove nan values
-        sheet_inclusion_list = [i for i in sheet_inclusion_list if not pd.isna(i)]
-
-        # Create dataframe
-        sheet_inclusion = pd.DataFrame({'dx_code': sheet_inclusion_list})
-        sheet_inclusion['pqe'] = pqe
-        sheet_inclusion['type'] = dx_type
-        sheet_inclusion['category'] = sheet
-
-        # Join to the other Chronic ASC conditions
-        temp_df = pd.concat([temp_df, sheet_inclusion], axis=0)
-        
-    return temp_df.reset_index(drop=True)
-      
-
-
-# Use the function above to pull in all relevant dx codes for each PQE
-#
-pqe01_inclusion = pqe_sheet_consolidation(
-  pqe='Dental Visit',
-  file_name = 'PQE_01_Visits_for_Dental_Conditions.xlsx',
-  sheet_list = ['DENTALVISIT'],
-  dx_type = 'Inclusion'
-)
-
-pqe01_exclusion = pqe_sheet_consolidation(
-  pqe='Dental Visit',
-  file_name = 'PQE_01_Visits_for_Dental_Conditions.xlsx',
-  sheet_list = ['TRAUMATOFACE'],
-  dx_type = 'Exclusion'
-)
-
-pqe02_inclusion = pqe_sheet_consolidation(
-  pqe='Chronic ASC',
-  file_name = 'PQE_02_Visits_for_Chronic_Conditions.xlsx',
-  sheet_list = ['ASTHMA', 'COPD', 'HEARTFAILURE', 'DMSTCX', 'CKD', 'LOWERRESPINFECTION'],
-  dx_type = 'Inclusion'
-)
-
-pqe03_inclusion = pqe_sheet_consolidation(
-  pqe='Acute ASC',
-  file_name = 'PQE_03_Visits_for_Acute_Conditions.xlsx',
-  sheet_list = ['UTI_NONCX', 'UPPERRESPINFECTION', 'INFLUENZA', 'CELLULITIS'],
-  dx_type = 'Inclusion'
-)
-
-pqe03_exclusion = pqe_sheet_consolidation(
-  pqe='Acute ASC',
-  file_name = 'PQE_03_Visits_for_Acute_Conditions.xlsx',
-  sheet_list = ['IMMUNOCOMPROMISED', 'DIABETES', 'QE03EXC_UTI', 'QE03EXC_UTM'],
-  dx_type = 'Exclusion'
-)
-
-pqe04_inclusion = pqe_sheet_consolidation(
-  pqe='Asthma',
-  file_name = 'PQE_04_Visits_for_Asthma.xlsx',
-  sheet_list = ['ASTHMA', 'QE4BRONCHITIS'],
-  dx_type = 'Inclusion'
-)
-
-pqe04_exclusion = pqe_sheet_consolidation(
-  pqe='Asthma',
-  file_name = 'PQE_04_Visits_for_Asthma.xlsx',
-  sheet_list = ['CYSTICFIBROSIS', 'RESPIRATORYANOMALIES', 'QE4EXC_PNEUMONIA'],
-  dx_type = 'Exclusion'
-)
-
-pqe05_inclusion = pqe_sheet_consolidation(
-  pqe='Back Pain',
-  file_name = 'PQE_05_Visits_for_BackPain.xlsx',
-  sheet_list = ['BACKPAIN'],
-  dx_type = 'Inclusion'
-)
-
-pqe05_exclusion = pqe_sheet_consolidation(
-  pqe='Back Pain',
-  file_name = 'PQE_05_Visits_for_BackPain.xlsx',
-  sheet_list = ['BPEXCLUDEUTI', 'BPEXCLUDEFEVER', 'BPEXCLUDECES'],
-  dx_type = 'Exclusion'
-)
-
-pqe05_exclusion_appendix_a = pqe_sheet_consolidation(
-  pqe='Back Pain',
-  file_name = 'ED_PQI_Appendix_A.xlsx',
-  sheet_list = ['APPENDIX A'],
-  dx_type = 'Exclusion'
-)
-
-pqe05_exclusion_appendix_b = pqe_sheet_consolidation(
-  pqe='Back Pain',
-  file_name = 'ED_PQI_Appendix_B.xlsx',
-  sheet_list = ['APPENDIX B '],
-  dx_type = 'Exclusion'
-)
-
-
-# Consolidate the files
-pqe_tables = [pqe01_inclusion, pqe01_exclusion,
-              pqe02_inclusion,
-              pqe03_inclusion, pqe03_exclusion,
-              pqe04_inclusion, pqe04_exclusion,
-              pqe05_inclusion, pqe05_exclusion, 
-              pqe05_exclusion_appendix_a, pqe05_exclusion_appendix_b]
-pqe_codes = pd.concat(pqe_tables, axis=0).reset_index(drop=True)
-
-
-# Format the dx codes to include decimals
-pqe_codes['dx_code'] = np.where(
-  pqe_codes['dx_code'].str.len() > 3,
-  pqe_codes['dx_code'].str.slice(start=0, stop=3)+'.'+pqe_codes['dx_code'].str.slice(start=3),
-  pqe_codes['dx_code']
-)
-
-# Strip any unnecessary whitespace from the category field
-pqe_codes['category'] = pqe_codes['category'].str.strip()
+if __name__ == '__main__':
+    main()
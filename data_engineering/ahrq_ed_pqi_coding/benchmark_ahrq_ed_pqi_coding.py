@@ -0,0 +1,283 @@
+'''
+Benchmarks for ahrq_ed_pqi_coding.py that run without network access.
+
+A synthetic AHRQ-shaped spec zip (same workbooks and sheets as the V2023 package, filled with
+random ICD-10-CM-like codes) is generated and placed in a temporary spec cache, and synthetic ED
+claim files with 25 diagnosis columns are generated at the requested numbers of diagnosis rows.
+
+Stages measured:
+  - build_cold: full code set build from the spec zip, with no parsed sheets cached.
+  - build_warm: rebuild of the same spec version, re-using the cached sheets.
+  - load: load of the code set artifact and its matcher.
+  - format: the decimal formatting step, on that many synthetic codes.
+  - classify: streaming scoring of a synthetic claims file.
+
+Each stage runs in its own forked process and reports its wall time, its throughput, and the peak
+RSS of that process.
+
+Usage:
+  python benchmark_ahrq_ed_pqi_coding.py --sizes 1000000 10000000 100000000 --output results.json
+'''
+
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+import openpyxl
+
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+spec_version = 'V2023'
+
+# Workbooks and sheets of the AHRQ V2023 ED PQI package
+synthetic_workbook_sheets = {
+  'PQE_01_Visits_for_Dental_Conditions.xlsx': ['DENTALVISIT', 'TRAUMATOFACE'],
+  'PQE_02_Visits_for_Chronic_Conditions.xlsx': ['ASTHMA', 'COPD', 'HEARTFAILURE', 'DMSTCX', 'CKD', 'LOWERRESPINFECTION'],
+  'PQE_03_Visits_for_Acute_Conditions.xlsx': ['UTI_NONCX', 'UPPERRESPINFECTION', 'INFLUENZA', 'CELLULITIS',
+                                              'IMMUNOCOMPROMISED', 'DIABETES', 'QE03EXC_UTI', 'QE03EXC_UTM'],
+  'PQE_04_Visits_for_Asthma.xlsx': ['ASTHMA', 'QE4BRONCHITIS', 'CYSTICFIBROSIS', 'RESPIRATORYANOMALIES', 'QE4EXC_PNEUMONIA'],
+  'PQE_05_Visits_for_BackPain.xlsx': ['BACKPAIN', 'BPEXCLUDEUTI', 'BPEXCLUDEFEVER', 'BPEXCLUDECES'],
+  'ED_PQI_Appendix_A.xlsx': ['APPENDIX A'],
+  'ED_PQI_Appendix_B.xlsx': ['APPENDIX B '],
+}
+
+
+
+# Synthetic data generators
+####################################################################
+
+# Random undotted ICD-10-CM-like codes: a letter followed by 2 to 6 digits
+def random_dx_codes(rng, n):
+
+    characters = np.zeros((n, 7), dtype=np.uint8)
+    characters[:, 0] = rng.integers(ord('A'), ord('Z')+1, n)
+    characters[:, 1:] = rng.integers(ord('0'), ord('9')+1, (n, 6))
+
+    # Blank out the characters past each code's length
+    lengths = rng.integers(3, 8, n)
+    characters[np.arange(7) >= lengths[:, None]] = 0
+
+    return characters.view('S7').ravel().astype(str)
+
+
+# Spec zip with the AHRQ workbook layout: a title row, a header row, and codes in the first and
+# fourth columns of every sheet. Returns the codes written.
+def write_synthetic_spec_zip(zip_path, codes_per_sheet, seed=0):
+
+    rng = np.random.default_rng(seed)
+    spec_codes = []
+
+    with ZipFile(zip_path, 'w', ZIP_DEFLATED) as zfile:
+        for file_name, sheet_list in synthetic_workbook_sheets.items():
+            workbook = openpyxl.Workbook(write_only=True)
+
+            for sheet in sheet_list:
+                worksheet = workbook.create_sheet(sheet)
+                worksheet.append([f'{sheet.strip()} diagnosis codes'])
+                worksheet.append(['ICD-10-CM Code', 'Description', None, 'ICD-10-CM Code', 'Description'])
+
+                first_column = random_dx_codes(rng, codes_per_sheet)
+                fourth_column = random_dx_codes(rng, codes_per_sheet // 2)
+                spec_codes += [first_column, fourth_column]
+                for row, code in enumerate(first_column):
+                    fourth = fourth_column[row] if row < len(fourth_column) else None
+                    worksheet.append([code, 'Synthetic description', None, fourth, 'Synthetic description' if fourth else None])
+
+            workbook_file = BytesIO()
+            workbook.save(workbook_file)
+            zfile.writestr(file_name, workbook_file.getvalue())
+
+    return np.concatenate(spec_codes)
+
+
+# Place a spec zip in the spec cache layout used by fetch_spec_zip, so no download happens
+def seed_spec_cache(cache_dir, zip_path, version=spec_version):
+
+    with open(zip_path, 'rb') as file:
+        content = file.read()
+    sha256 = hashlib.sha256(content).hexdigest()
+
+    os.makedirs(os.path.join(cache_dir, 'blobs'), exist_ok=True)
+    os.makedirs(os.path.join(cache_dir, 'versions'), exist_ok=True)
+    with open(os.path.join(cache_dir, 'blobs', f'{sha256}.zip'), 'wb') as file:
+        file.write(content)
+    with open(os.path.join(cache_dir, 'versions', f'{version}.json'), 'w') as file:
+        json.dump({'version': version, 'url': 'synthetic', 'sha256': sha256,
+                   'downloaded': datetime.datetime.now().isoformat(timespec='seconds')}, file)
+
+
+# ED claims CSV with 25 diagnosis columns and ceil(dx_rows / 25) claims, written in chunks.
+# Roughly hit_rate of the diagnoses are drawn from the spec codes, the rest are random codes.
+def write_synthetic_claims(file_path, dx_rows, spec_codes, hit_rate=0.3, dx_columns=25, chunk_claims=200_000, seed=0):
+
+    rng = np.random.default_rng(seed)
+    n_claims = math.ceil(dx_rows / dx_columns)
+
+    with open(file_path, 'w') as file:
+        file.write(','.join(['claim_id'] + [f'dx{position}' for position in range(1, dx_columns+1)]) + '\n')
+
+        for first_claim in range(0, n_claims, chunk_claims):
+            n_chunk = min(chunk_claims, n_claims - first_claim)
+            dx_codes = random_dx_codes(rng, n_chunk * dx_columns).astype(object)
+            hits = rng.random(n_chunk * dx_columns) < hit_rate
+            dx_codes[hits] = rng.choice(spec_codes, hits.sum())
+
+            rows = np.column_stack([np.arange(first_claim, first_claim + n_chunk).astype(str),
+                                    dx_codes.reshape(n_chunk, dx_columns)])
+            file.write('\n'.join(','.join(row) for row in rows) + '\n')
+
+    return n_claims
+
+
+
+# Stage runner
+####################################################################
+
+# Run a stage in a forked process and report its wall time and the process peak RSS
+def run_stage(stage, *args):
+
+    def child(connection):
+        # Import the module before the clock starts
+        pqi = import_pqi_module()
+        start = time.perf_counter()
+        units = stage_functions[stage](pqi, *args)
+        wall_seconds = time.perf_counter() - start
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        connection.send({'wall_seconds': wall_seconds, 'peak_rss_mb': peak_rss_mb, 'units': units})
+
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.get_context('fork').Process(target=child, args=(child_connection,))
+    process.start()
+
+    # Close the parent's copy of the child's end, so a failed stage ends recv() with EOFError
+    child_connection.close()
+    try:
+        measurement = parent_connection.recv()
+    except EOFError:
+        raise RuntimeError(f'The {stage} stage failed; see the error above.') from None
+    finally:
+        process.join()
+
+    return measurement
+
+
+def import_pqi_module():
+
+    sys.path.insert(0, script_dir)
+    import ahrq_ed_pqi_coding
+    return ahrq_ed_pqi_coding
+
+
+# Each stage returns the number of units it processed (codes or diagnosis rows)
+def build_stage(pqi):
+
+    return len(pqi.build())
+
+
+def load_stage(pqi):
+
+    artifact_dir = pqi.artifact_path()
+    pqe_codes = pqi.load_pqe_codes(artifact_dir)
+    pqi.PqeMatcher.from_artifact(artifact_dir)
+    return len(pqe_codes)
+
+
+def format_stage(pqi, n_codes, seed):
+
+    import pandas as pd
+
+    pqe_codes = pd.DataFrame({'dx_code': random_dx_codes(np.random.default_rng(seed), n_codes).astype(object),
+                                  'category': 'SYNTHETIC '})
+    pqi.format_pqe_codes(pqe_codes)
+    return n_codes
+
+
+def classify_stage(pqi, claims_path, output_path, dx_rows):
+
+    pqi.score_claims_file(claims_path, output_path, matcher=pqi.PqeMatcher.from_artifact(pqi.artifact_path()))
+    return dx_rows
+
+
+stage_functions = {
+  'build': build_stage,
+  'load': load_stage,
+  'format': format_stage,
+  'classify': classify_stage,
+}
+
+
+
+# Benchmark run
+####################################################################
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000, 100_000_000],
+                        help='numbers of claim diagnosis rows to classify')
+    parser.add_argument('--max-format-size', type=int, default=10_000_000,
+                        help='largest size for the in-memory formatting stage')
+    parser.add_argument('--codes-per-sheet', type=int, default=2000)
+    parser.add_argument('--work-dir', help='directory for the synthetic files (a temporary directory by default)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pqi_benchmark_')
+    cache_dir = os.path.join(work_dir, 'cache')
+    os.makedirs(work_dir, exist_ok=True)
+
+    # The module reads its cache settings at import; keep every stage offline
+    os.environ['AHRQ_PQI_CACHE_DIR'] = cache_dir
+    os.environ['AHRQ_PQI_OFFLINE'] = '1'
+
+    zip_path = os.path.join(work_dir, 'spec.zip')
+    spec_codes = write_synthetic_spec_zip(zip_path, args.codes_per_sheet, args.seed)
+    seed_spec_cache(cache_dir, zip_path)
+
+    results = []
+    def record(stage, size, measurement):
+        results.append({'stage': stage, 'size': size, **measurement,
+                        'units_per_second': measurement['units'] / measurement['wall_seconds']})
+        print(f"{stage:>10} {size:>12,} rows {measurement['wall_seconds']:9.2f} s "
+              f"{results[-1]['units_per_second']:14,.0f} rows/s {measurement['peak_rss_mb']:9.0f} MB peak RSS")
+
+    build_measurement = run_stage('build')
+    record('build_cold', build_measurement['units'], build_measurement)
+    build_measurement = run_stage('build')
+    record('build_warm', build_measurement['units'], build_measurement)
+    load_measurement = run_stage('load')
+    record('load', load_measurement['units'], load_measurement)
+
+    for size in args.sizes:
+        if size <= args.max_format_size:
+            record('format', size, run_stage('format', size, args.seed))
+
+        claims_path = os.path.join(work_dir, f'claims_{size}.csv')
+        write_synthetic_claims(claims_path, size, spec_codes, seed=args.seed)
+        record('classify', size, run_stage('classify', claims_path, os.path.join(work_dir, f'scored_{size}.csv'), size))
+        os.remove(claims_path)
+        os.remove(os.path.join(work_dir, f'scored_{size}.csv'))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'sizes': args.sizes, 'codes_per_sheet': args.codes_per_sheet, 'results': results}, file, indent=2)
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
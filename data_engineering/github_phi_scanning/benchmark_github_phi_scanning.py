@@ -0,0 +1,399 @@
+'''
+Benchmarks for github_phi_scanning.py that run without network access.
+
+A synthetic git repository (a main branch and feature branches that each change some of its
+files, with PHI-like values at a chosen density) is generated and published as a local bare
+"remote", and a local stand-in GitHub server serves synthetic Issues and Pull Requests, both as
+REST API listings and as HTML pages.
+
+Stages measured:
+  - scan_file: scan_file_for_phi on one synthetic file.
+  - scan_directory: scan_directory_for_phi on a checkout of the main branch.
+  - issue_scan: the Issue and Pull Request scan alone, against the local server.
+  - repository_scan: the full repository_phi_scan flow (clone, branch scan and Issue scan).
+
+Each stage runs in its own forked process and reports its wall time, MB/s, files/s and issues/s
+where they apply, and the peak RSS of that process. The scanner's progress output is discarded.
+
+Usage:
+  python benchmark_github_phi_scanning.py --branches 4 --files 500 --file-kb 64 --issues 1000 --output results.json
+'''
+
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The synthetic repository's SSH link. Git rewrites it to the local bare remote (url.<base>.insteadOf).
+synthetic_owner_repo = 'synthetic/repo'
+synthetic_ssh_host = 'git@benchmark.local:'
+synthetic_ssh_link = f'{synthetic_ssh_host}{synthetic_owner_repo}.git'
+
+
+
+# Synthetic data generators
+####################################################################
+
+filler_words = ['select', 'from', 'where', 'join', 'on', 'and', 'or', 'group', 'by', 'order', 'count', 'sum',
+                'member_id', 'claim_status', 'service_date', 'provider', 'facility', 'df', 'import', 'return',
+                'def', 'if', 'else', 'for', 'in', 'the', 'a', 'of', 'to', 'is', '=', '+', '(', ')', ',', '1', '0']
+
+
+# A PHI-like value of one of the `patterns` types
+def random_phi_value(rng):
+
+    return rng.choice([
+      lambda: f'MEM{rng.randrange(10**5, 10**7)}',
+      lambda: f'{rng.randrange(10**8):08d}{rng.choice("ABCDEFGH")}',
+      lambda: f'{rng.randrange(10**3):03d}-{rng.randrange(10**2):02d}-{rng.randrange(10**4):04d}',
+      lambda: f'{rng.randrange(10**3):03d}-{rng.randrange(10**4):04d}',
+    ])()
+
+
+# Text of about n_bytes in lines of filler words, where a phi_density share of the lines carry a
+# PHI-like value. Lines are drawn from a pool so that large files are generated quickly.
+def synthetic_text(rng, n_bytes, phi_density, line_pool = None):
+
+    line_pool = line_pool or [' '.join(rng.choices(filler_words, k=rng.randint(4, 14))) for _ in range(1000)]
+    lines, size = [], 0
+    while size < n_bytes:
+        line = rng.choice(line_pool)
+        if rng.random() < phi_density:
+            line = f'{line} {random_phi_value(rng)}'
+        lines.append(line)
+        size += len(line) + 1
+
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def git(repo_directory, *args):
+
+    subprocess.run(['git', '-C', repo_directory, '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@example.com',
+                    *args], check=True, stdout=subprocess.DEVNULL)
+
+
+# Repository with n_files on a main branch and n_branches feature branches that each rewrite
+# changed_files of them, published as a bare remote at <remote_root>/<synthetic_owner_repo>.git.
+# Returns {'files': files over all branch heads, 'bytes': bytes over all branch heads}.
+def write_synthetic_repository(work_directory, remote_root, n_branches, n_files, file_bytes, changed_files, phi_density, seed = 0):
+
+    rng = random.Random(seed)
+    line_pool = [' '.join(rng.choices(filler_words, k=rng.randint(4, 14))) for _ in range(1000)]
+    suffixes = ['.py', '.sql', '.R', '.md', '.csv', '.txt']
+
+    subprocess.run(['git', 'init', '--quiet', '--initial-branch=main', work_directory], check=True)
+    file_sizes = {}
+    for number in range(n_files):
+        path = os.path.join(f'module_{number % 20:02d}', f'file_{number:05d}{suffixes[number % len(suffixes)]}')
+        os.makedirs(os.path.join(work_directory, os.path.dirname(path)), exist_ok=True)
+        content = synthetic_text(rng, file_bytes, phi_density, line_pool)
+        with open(os.path.join(work_directory, path), 'wb') as file:
+            file.write(content)
+        file_sizes[path] = len(content)
+    git(work_directory, 'add', '--all')
+    git(work_directory, 'commit', '--quiet', '-m', 'Synthetic main branch')
+
+    branch_sizes = [dict(file_sizes)]
+    for branch in range(n_branches):
+        git(work_directory, 'checkout', '--quiet', '-b', f'feature/synthetic_{branch}', 'main')
+        sizes = dict(file_sizes)
+        for path in rng.sample(sorted(file_sizes), min(changed_files, n_files)):
+            content = synthetic_text(rng, file_bytes, phi_density, line_pool)
+            with open(os.path.join(work_directory, path), 'wb') as file:
+                file.write(content)
+            sizes[path] = len(content)
+        git(work_directory, 'commit', '--quiet', '--all', '-m', f'Synthetic feature branch {branch}')
+        branch_sizes.append(sizes)
+    git(work_directory, 'checkout', '--quiet', 'main')
+
+    remote_directory = os.path.join(remote_root, f'{synthetic_owner_repo}.git')
+    subprocess.run(['git', 'clone', '--bare', '--quiet', work_directory, remote_directory], check=True)
+
+    return {'files': sum(len(sizes) for sizes in branch_sizes),
+            'bytes': sum(sum(sizes.values()) for sizes in branch_sizes)}
+
+
+# Issues (open and closed, some of them Pull Requests) with comments and review comments
+def synthetic_issues(n_issues, comments_per_issue, phi_density, seed = 0):
+
+    rng = random.Random(seed)
+    issue_url = f'https://benchmark.local/repos/{synthetic_owner_repo}'
+
+    def body():
+        text = synthetic_text(rng, rng.randint(200, 2000), phi_density * 10).decode()
+        return text + ('\n![image](https://dsghe.example/screenshot.png)' if rng.random() < 0.02 else '')
+
+    issues = [{'number': number, 'title': f'Synthetic issue {number}', 'body': body(), 'state': 'closed' if number % 3 else 'open',
+               'pull_request': {} if number % 4 == 0 else None}
+              for number in range(1, n_issues + 1)]
+    comments = [{'issue_url': f'{issue_url}/issues/{issue["number"]}', 'body': body()}
+                for issue in issues for _ in range(comments_per_issue)]
+    review_comments = [{'pull_request_url': f'{issue_url}/pulls/{issue["number"]}', 'body': body()}
+                       for issue in issues if issue['pull_request'] is not None]
+
+    return issues, comments, review_comments
+
+
+
+# Local stand-in GitHub server
+####################################################################
+
+# Serves the synthetic Issues as REST API listings (/api/v3/...) and as the HTML login, Issue
+# listing and Issue pages that the HTML mode scrapes
+class SyntheticGitHubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    issues, comments, review_comments = [], [], []
+    html_page_size = 25
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type, headers = {}):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_body('', 'text/html')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        repo_path = f'/{synthetic_owner_repo}'
+        api_repo_path = f'/api/v3/repos/{synthetic_owner_repo}'
+
+        listings = {f'{api_repo_path}/issues': self.issues, f'{api_repo_path}/issues/comments': self.comments,
+                    f'{api_repo_path}/pulls/comments': self.review_comments}
+
+        if url.path in listings:
+            items = listings[url.path]
+            per_page, page = int(query.get('per_page', ['30'])[0]), int(query.get('page', ['1'])[0])
+            last_page = max(1, math.ceil(len(items) / per_page))
+            link = f'<http://{self.headers["Host"]}{url.path}?per_page={per_page}&page={last_page}>; rel="last"'
+            self.send_body(json.dumps(items[(page-1)*per_page:page*per_page]), 'application/json', {'Link': link})
+
+        elif url.path == api_repo_path:
+            self.send_body(json.dumps({'full_name': synthetic_owner_repo, 'size': 0, 'pushed_at': ''}), 'application/json')
+
+        elif url.path == '/login':
+            self.send_body('<form><input name="authenticity_token" value="benchmark"></form>', 'text/html')
+
+        elif url.path == f'{repo_path}/issues':
+            page = int(query.get('page', ['1'])[0])
+            total_pages = max(1, math.ceil(len(self.issues) / self.html_page_size))
+            rows = ''.join(f'<div class="Box-row js-issue-row"><a class="Link--primary" href="{repo_path}/issues/{issue["number"]}">'
+                           f'{issue["title"]}</a></div>'
+                           for issue in self.issues[(page-1)*self.html_page_size:page*self.html_page_size])
+            pagination = (f'<div class="paginate-container d-none d-sm-flex flex-sm-justify-center">'
+                          f'<em class="current" data-total-pages="{total_pages}">{page}</em></div>')
+            self.send_body(f'<html><body>{rows}{pagination}</body></html>', 'text/html')
+
+        elif url.path.startswith(f'{repo_path}/issues/'):
+            number = int(url.path.rsplit('/', 1)[1])
+            texts = [self.issues[number - 1]['body']] + [comment['body'] for comment in self.comments
+                                                         if comment['issue_url'].endswith(f'/issues/{number}')]
+            blocks = ''.join(f'<td class="d-block user-select-contain">{text}</td>' for text in texts)
+            self.send_body(f'<html><body><table><tr>{blocks}</tr></table></body></html>', 'text/html')
+
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+def start_synthetic_github(issues, comments, review_comments):
+
+    SyntheticGitHubHandler.issues = issues
+    SyntheticGitHubHandler.comments = comments
+    SyntheticGitHubHandler.review_comments = review_comments
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SyntheticGitHubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+
+# Stage runner
+####################################################################
+
+# Run a stage in a forked process and report its wall time and the process peak RSS
+def run_stage(stage, settings, *args):
+
+    def child(connection):
+        # Import the module and apply the settings before the clock starts
+        phi = import_phi_module()
+        for name, value in settings.items():
+            setattr(phi, name, value)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            units = stage_functions[stage](phi, *args)
+            wall_seconds = time.perf_counter() - start
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        connection.send({'wall_seconds': wall_seconds, 'peak_rss_mb': peak_rss_mb, **units})
+
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.get_context('fork').Process(target=child, args=(child_connection,))
+    process.start()
+
+    # Close the parent's copy of the child's end, so a failed stage ends recv() with EOFError
+    child_connection.close()
+    try:
+        measurement = parent_connection.recv()
+    except EOFError:
+        raise RuntimeError(f'The {stage} stage failed; see the error above.') from None
+    finally:
+        process.join()
+
+    return measurement
+
+
+def import_phi_module():
+
+    sys.path.insert(0, script_dir)
+    import github_phi_scanning
+    return github_phi_scanning
+
+
+# Each stage returns the bytes, files and issues it scanned
+def scan_file_stage(phi, file_path):
+
+    phi.scan_file_for_phi(file_path)
+    return {'bytes': os.path.getsize(file_path), 'files': 1}
+
+
+def scan_directory_stage(phi, directory_path, workers):
+
+    phi.scan_directory_for_phi(directory_path, workers)
+    sizes = [os.path.getsize(os.path.join(root, file_name)) for root, dirs, files in os.walk(directory_path)
+             if '.git' not in root.split(os.sep) for file_name in files if file_name.endswith(phi.scan_file_suffixes)]
+    return {'bytes': sum(sizes), 'files': len(sizes)}
+
+
+def issue_scan_stage(phi, github_url, issue_mode, n_issues):
+
+    sink = phi.FindingsSink()
+    if issue_mode == 'api':
+        phi.repository_issue_api_scan(github_url, synthetic_owner_repo, 'benchmark', 'benchmark', sink)
+    else:
+        phi.repository_issue_scan(github_url, synthetic_owner_repo, 'benchmark', 'benchmark', sink)
+    return {'issues': n_issues}
+
+
+def repository_scan_stage(phi, local_root_directory, github_url, scan_mode, issue_mode, workers, repository_units, n_issues):
+
+    phi.repository_phi_scan(synthetic_ssh_link, local_root_directory, github_url, 'benchmark', 'benchmark',
+                            scan_mode=scan_mode, workers=workers, issue_mode=issue_mode)
+    return {**repository_units, 'issues': n_issues}
+
+
+stage_functions = {
+  'scan_file': scan_file_stage,
+  'scan_directory': scan_directory_stage,
+  'issue_scan': issue_scan_stage,
+  'repository_scan': repository_scan_stage,
+}
+
+
+
+# Benchmark run
+####################################################################
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--branches', type=int, default=4, help='feature branches besides main')
+    parser.add_argument('--files', type=int, default=500, help='files on the main branch')
+    parser.add_argument('--file-kb', type=int, default=64, help='size of each repository file')
+    parser.add_argument('--changed-files', type=int, default=50, help='files rewritten on each feature branch')
+    parser.add_argument('--phi-density', type=float, default=0.01, help='share of lines with a PHI-like value')
+    parser.add_argument('--single-file-mb', type=int, default=256, help='size of the scan_file stage file')
+    parser.add_argument('--issues', type=int, default=1000)
+    parser.add_argument('--comments-per-issue', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--scan-modes', nargs='+', default=['blobs', 'checkout'], choices=['blobs', 'checkout', 'history'])
+    parser.add_argument('--issue-modes', nargs='+', default=['api', 'html'], choices=['api', 'html'])
+    parser.add_argument('--requests-per-second', type=float, default=1000, help='Issue crawl rate limit')
+    parser.add_argument('--work-dir', help='directory for the synthetic files (a temporary directory by default)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='phi_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    # Git (in every stage process) resolves the synthetic SSH link to the local bare remote
+    remote_root = os.path.join(work_dir, 'remotes')
+    os.environ.update({'GIT_CONFIG_COUNT': '1', 'GIT_CONFIG_KEY_0': f'url.{remote_root}/.insteadOf',
+                       'GIT_CONFIG_VALUE_0': synthetic_ssh_host})
+
+    repository_directory = os.path.join(work_dir, 'repository')
+    repository_units = write_synthetic_repository(repository_directory, remote_root, args.branches, args.files,
+                                                  args.file_kb * 1024, args.changed_files, args.phi_density, args.seed)
+
+    single_file_path = os.path.join(work_dir, 'single_file.sql')
+    with open(single_file_path, 'wb') as file:
+        file.write(synthetic_text(random.Random(args.seed), args.single_file_mb * 1024 * 1024, args.phi_density))
+
+    server, github_url = start_synthetic_github(*synthetic_issues(args.issues, args.comments_per_issue, args.phi_density, args.seed))
+    settings = {'issue_requests_per_second': args.requests_per_second}
+
+    results = []
+    def record(stage, measurement, **labels):
+        rates = {f'{unit}_per_second': measurement[unit] / measurement['wall_seconds'] for unit in ['files', 'issues'] if unit in measurement}
+        if 'bytes' in measurement:
+            rates['mb_per_second'] = measurement['bytes'] / 1024 / 1024 / measurement['wall_seconds']
+        results.append({'stage': stage, **labels, **measurement, **rates})
+        print(f"{stage:>16} {' '.join(str(value) for value in labels.values()):>18} {measurement['wall_seconds']:9.2f} s"
+              + ''.join(f' {value:12,.1f} {name.replace("_per_second", "").replace("mb", "MB")}/s' for name, value in rates.items())
+              + f" {measurement['peak_rss_mb']:9.0f} MB peak RSS")
+
+    record('scan_file', run_stage('scan_file', settings, single_file_path))
+    record('scan_directory', run_stage('scan_directory', settings, repository_directory, 1), workers=1)
+    if args.workers > 1:
+        record('scan_directory', run_stage('scan_directory', settings, repository_directory, args.workers), workers=args.workers)
+
+    for issue_mode in args.issue_modes:
+        record('issue_scan', run_stage('issue_scan', settings, github_url, issue_mode, args.issues), issue_mode=issue_mode)
+
+    for scan_mode in args.scan_modes:
+        local_root_directory = os.path.join(work_dir, f'scan_{scan_mode}')
+        os.makedirs(local_root_directory, exist_ok=True)
+        record('repository_scan', run_stage('repository_scan', settings, local_root_directory, github_url, scan_mode,
+                                            args.issue_modes[0], args.workers, repository_units, args.issues),
+               scan_mode=scan_mode, issue_mode=args.issue_modes[0])
+
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'settings': vars(args), 'results': results}, file, indent=2)
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
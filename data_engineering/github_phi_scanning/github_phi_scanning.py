@@ -7,11 +7,70 @@ for specified PHI syntax, through regular expressions.
 Scanning operations:
   1. Scans all files with the following suffix values from each remote branch of the specified
      GitHub repository, identifying potential PHI values: 
-     '.py', '.r', '.R', '.hql', '.sql', '.HQL', '.SQL', '.csv', '.txt'
+     '.py', '.r', '.R', '.hql', '.sql', '.HQL', '.SQL', '.md', '.csv', '.txt'
+     By default (`scan_mode = 'blobs'`), the repository is cloned bare and the files of every
+     branch head are read straight from git through one `git cat-file --batch` process. Each
+     unique file version (blob) is scanned once, and its findings are reported for every branch
+     and path that contains it. `scan_mode = 'checkout'` checks out and walks each branch instead.
+     With `workers = N`, files (or blob contents) are grouped into batches of small files and
+     scanned in a pool of N processes; results come back in the same order as a serial scan.
+     Worker processes are started by a forkserver, not forked, so a script that scans with
+     workers must run the scan under `if __name__ == '__main__':`.
+     Files and blobs are read in 4 MB chunks (`scan_chunk_bytes`), never whole, so a multi-GB
+     file committed by mistake is scanned in constant memory. Consecutive chunks overlap by
+     `scan_overlap_bytes`, so a PHI value across a chunk boundary is found exactly once.
+     Archives and compressed files ('.zip', '.xlsx', '.gz', '.tgz', '.bz2', '.tar') are scanned
+     too. Content is identified by its leading bytes, not its name: gzip, bz2, tar and zip
+     content is decompressed as a stream and each member is scanned (nested archives
+     included), without extracting anything to disk, and other binary content (a NUL byte in
+     the first 8 KB) is skipped. Decompression is stopped past `archive_max_bytes`, a
+     compression ratio of `archive_max_ratio`, or `archive_max_depth` nested archives; such a
+     file, or an unreadable or encrypted archive, is reported with the
+     'archive_not_fully_scanned' type for manual review.
+     With `scan_cache = <path>` (e.g. `scan_cache_path`, `~/.cache/github_phi_scanning/scan_cache.sqlite`),
+     the bare clone is kept and fetched on the next run, and a SQLite cache records the findings
+     of every scanned blob and the last scanned commit of every branch. Later runs only read
+     branches that moved and blobs that were never scanned. Blob findings are committed every
+     `scan_cache_batch_blobs` blobs, so a scan that is interrupted keeps most of its work.
+     The cache is cleared automatically
+     when `patterns` or the scanned file types change.
+     `scan_mode = 'history'` scans every file version ever committed to any branch, so PHI
+     that was committed and later deleted is still found. `git log --raw` is streamed, each
+     distinct blob is scanned once as it appears, and each finding is reported with the commit,
+     author and path that introduced it.
   2. Scans all open and closed Issues and Pull Requests included within the remote GitHub
      repository to:
      a. identifying potential PHI values.
      b. identify screenshots.
+     Issue pages are fetched concurrently by an asyncio crawler (`AsyncHttpFetcher`) over a pool
+     of keep-alive connections, with at most `issue_fetch_concurrency` requests in flight, a
+     token-bucket limit of `issue_requests_per_second`, and retries with exponential backoff.
+     Pages are parsed and scanned in worker threads while other requests are in flight. Since
+     every URL is built from `github_url`, the crawl can run against a local stand-in server.
+     An Issue or listing page that still fails after retries (e.g. deleted after it was listed)
+     is reported with the 'issue_not_scanned' type for manual review, and the crawl goes on.
+     By default (`issue_mode = 'html'`), the web pages are scraped after logging in with the
+     GitHub username and password. With `issue_mode = 'api'`, Issues, Pull Requests, their
+     comments and their review comments are read as JSON from the GitHub REST API instead, 100
+     per page with the pages fetched concurrently, and only their body text is scanned; the
+     REST API needs a personal access token as the password.
+     With `scan_cache`, each fetched page's ETag / Last-Modified is stored with its scan results,
+     and later runs send conditional requests: a page answered with 304 Not Modified is neither
+     downloaded nor parsed again, and its stored results are reused. API listings are read
+     oldest first, so only pages with new or edited Issues and comments are scanned again.
+
+Organization-wide scans:
+  `organization_phi_scan(repo_ssh_links, ...)` runs `repository_phi_scan` for a list of
+  repositories across a pool of `repo_workers` concurrent scan jobs. Each repository is cloned
+  and scanned in its own working directory (`<local_root_directory>/<owner>_<repo>`); no scan
+  mode changes the process working directory, so jobs do not interfere. With `priority = 'size'`
+  (the default) the largest repositories, per the GitHub REST API, are started first so they do
+  not run alone at the end; `priority = 'pushed'` starts the most recently changed ones first.
+  As each job ends, its three reports are written to one shared SQLite results store
+  (`results_store`, `PhiResultsStore`), replacing any earlier scan of that repository. A
+  repository that fails to scan is recorded as failed and the other jobs continue.
+  `PhiResultsStore(path).report('branches')` (or `'issues'`, `'images'`) returns every
+  repository's rows with a leading `repo` column, and `.scans()` the status of every scan.
      
 Function outputs:
   1. branches_df: This provides a list of all 
@@ -23,28 +82,97 @@ Function outputs:
   3. images_df: This provides a list of 
      the Issues and Pull Request of the GitHub repository that contain a screenshot. The 
      screenshot may not contain PHI, but each one needs to be manually reviewed and validated.
+  With `findings_sink`, each report record is written to the sink as soon as it is found, and
+  `repository_phi_scan` returns the sink instead of the DataFrames. `JsonlFindingsSink(directory)`
+  appends one JSON line per record to `<report>.jsonl`, and `ParquetFindingsSink(directory)`
+  writes `<report>/part-NNNNN.parquet` files of `row_group_rows` records each (needs `pyarrow`),
+  so large scans run in bounded memory. A smaller part is also written with the first record
+  that arrives `flush_seconds` (30 s) after the last part, and at the end of the file scan; a
+  crash loses only the records found since the last part was written.
+  `sink.dataframe('branches')` (or `'history'`, `'issues'`, `'images'`) assembles a report only
+  when it is asked for. A new sink removes the reports an earlier run left in its directory.
      
 
 Access Requirements:
   1. The ability to clone the target remote repository through an SSH connection.
-  2. A GitHub username and password that has access to the target remote repository.
+  2. A GitHub username and password (a personal access token for the API mode) that has access
+     to the target remote repository.
   
 
 Notes:
   - This script's `patterns` objects defines the potential PHI being identified. Each
     organization will have different member and claim syntaxes, and the patterns need
     to be updated appropriately.
+  - All `patterns` are matched in one pass over each file or Issue (`PhiMatcher`, via
+    `get_phi_matcher()`), so adding organization-specific patterns does not add a full pass per
+    pattern. `matcher.finditer(content)` returns typed matches with byte offsets. Where two
+    patterns match at the same position, the one listed first in `patterns` is reported.
+    Patterns can use inline flags, either for the whole pattern (`(?i)mem[0-9]+`) or for a group
+    (`(?i:mem)[0-9]+`).
+  - `known_non_phi_list` suppresses values that look like PHI but are not (e.g. synthetic test
+    member IDs). It can be a list of values (suppressed for every pattern type), a
+    `{phi_type: values}` dict, or a `PhiAllowlist`, e.g.
+    `PhiAllowlist.from_files('test_ids.txt')` for files with one `value` or `phi_type,value`
+    per line. Values are held in hashed sets per pattern type and checked as each match is
+    found, so hundreds of thousands of them cost one set lookup per match, and suppressed
+    values never reach the reports or the caches. Changing the allowlist clears `scan_cache`.
   - The repositories being scanned must have "Issues" enabled in order to scan the Issues.
 
+Instrumentation:
+  With metrics_output = <path>, repository_phi_scan (and organization_phi_scan, for all of
+  its jobs together) records where the scan time goes and writes it as JSON at the end: the wall
+  time and count of each phase ('git_clone', 'git_fetch', 'branch_checkout', 'git_list_files',
+  'git_log', 'directory_walk', 'file_read', 'regex_match', 'http_fetch', 'html_parse',
+  'json_parse', and 'branch_scan' / 'issue_scan' per repository), counters ('files_scanned',
+  'bytes_scanned', 'http_requests', 'http_retries', 'http_not_modified'), and for each pattern its
+  matches and its time on its own over the first pattern_sample_bytes (16 MB) scanned, since
+  the combined regex cannot say which pattern the time went to. Worker processes send their
+  metrics back with each batch. Phases that run concurrently each add their own time, so totals
+  can exceed the wall time. trace_output = <path> also writes a Chrome trace (open it in
+  chrome://tracing or https://ui.perfetto.dev) with every phase of at least trace_min_seconds,
+  one row per process and thread. with instrumented_scan(metrics_output, trace_output) as
+  metrics: instruments any other scan function, and metrics.summary() returns the same dict.
+  Uninstrumented scans only check that scan_metrics is None.
+
+Benchmarks:
+  `benchmark_github_phi_scanning.py` measures `scan_file_for_phi`, `scan_directory_for_phi`, the
+  Issue scan and the full `repository_phi_scan` flow without network access. It generates a
+  local git repository (`--branches`, `--files`, `--file-kb`, `--phi-density`) published as a
+  bare remote that the synthetic SSH link resolves to, and serves synthetic Issues from a
+  local stand-in GitHub server (REST API and HTML pages). Each stage reports wall time, MB/s,
+  files/s and issues/s (counting the files of every branch head), and peak RSS; `--output`
+  saves the results as JSON for comparing runs:
+
+      python benchmark_github_phi_scanning.py --files 500 --file-kb 64 --issues 1000 --output results.json
+
 requirements.txt included. Excecuted in Python 3.10
 '''
 
 import os
+import io
 import subprocess
 import re
-from bs4 import BeautifulSoup
+import functools
+import gzip
+import bz2
+import zipfile
+import tarfile
+import tempfile
+import shutil
+import asyncio
+import random
+import hashlib
+import json
+import multiprocessing
+import sqlite3
+import threading
+import contextlib
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from bs4 import BeautifulSoup, SoupStrainer
 import requests
-from time import time
+from urllib.parse import urlparse, parse_qs, urlencode
+from time import time, monotonic, perf_counter
 import pytz
 from datetime import datetime
 import pandas as pd
@@ -64,49 +192,777 @@ patterns = {
 }
 
 
-# Function to scan file for PHI
-def scan_file_for_phi(file_path):
+# File types that are scanned for PHI
+scan_file_suffixes = ('.py', '.R', '.r', '.hql', '.sql', '.HQL', '.SQL', '.md', '.txt', '.csv')
+
+# Archive and compressed file types whose contents are also scanned (see scan_content)
+scan_archive_suffixes = ('.zip', '.xlsx', '.gz', '.tgz', '.bz2', '.tar')
+
+
+# ------------------------------------------------------------
+# One-pass matcher for all PHI patterns
+# ------------------------------------------------------------
+try:
+    from re import _parser as regex_parser
+except ImportError:  # Python 3.10
+    import sre_parse as regex_parser
+
+
+# A PHI match: its pattern type, matched text, and start/end offsets. Text is decoded as
+# ISO 8859-1 (one character per byte), so the offsets are also byte offsets into the file.
+PhiMatch = namedtuple('PhiMatch', ['phi_type', 'value', 'start', 'end'])
+
+
+# Character class (e.g. '\dMX') of the characters a regex match can start with, or None if it
+# cannot be determined. Used to skip, inside the regex engine, positions where no pattern can match.
+def pattern_first_characters(pattern):
+
+    def first_characters(items):
+        for op, av in items:
+            if op is regex_parser.AT:
+                continue  # \b, ^, ...: zero-width, look at the next item
+            if op is regex_parser.LITERAL:
+                return re.escape(chr(av))
+            if op is regex_parser.IN:
+                characters = ''
+                for set_op, set_av in av:
+                    if set_op is regex_parser.LITERAL:
+                        characters += re.escape(chr(set_av))
+                    elif set_op is regex_parser.RANGE:
+                        characters += f'{re.escape(chr(set_av[0]))}-{re.escape(chr(set_av[1]))}'
+                    elif set_op is regex_parser.CATEGORY and set_av in category_classes:
+                        characters += category_classes[set_av]
+                    else:
+                        return None
+                return characters
+            if op is regex_parser.BRANCH:
+                branches = [first_characters(branch) for branch in av[1]]
+                return ''.join(branches) if all(branches) else None
+            if op is regex_parser.SUBPATTERN:
+                if av[1] or av[2]:
+                    return None  # scoped flags, e.g. (?i:...), change what the group matches
+                return first_characters(av[-1])
+            if op in (regex_parser.MAX_REPEAT, regex_parser.MIN_REPEAT) and av[0] > 0:
+                return first_characters(av[2])
+            return None
+        return None
+
+    category_classes = {
+        regex_parser.CATEGORY_DIGIT: r'\d',
+        regex_parser.CATEGORY_WORD: r'\w',
+        regex_parser.CATEGORY_SPACE: r'\s',
+    }
+
+    parsed = regex_parser.parse(pattern)
+    if parsed.state.flags & re.IGNORECASE:
+        return None
+
+    return first_characters(parsed)
+
+
+# A pattern with leading global inline flags, e.g. '(?i)mem\d+', as the same pattern with scoped
+# flags, '(?i:mem\d+)', so that it can be one alternative of the combined regex
+def scoped_flags_pattern(pattern):
+
+    flags = ''
+    while (match := re.match(r'\(\?([aiLmsux]+)\)', pattern)):
+        flags += match.group(1)
+        pattern = pattern[match.end():]
+
+    if not flags:
+        return pattern
+
+    # In verbose mode a trailing comment would swallow the closing parenthesis
+    return f'(?{flags}:{pattern}\n)' if 'x' in flags else f'(?{flags}:{pattern})'
+
+
+# Files are scanned in chunks of this many bytes. Each chunk is scanned together with the last
+# scan_overlap_bytes of the previous one, so PHI values up to that length are found across chunk
+# boundaries, and memory use does not depend on the file size.
+scan_chunk_bytes = 4 * 1024 * 1024
+scan_overlap_bytes = 4096
+
+
+# ------------------------------------------------------------
+# Scan instrumentation: time per phase, bytes scanned, and matches and time per pattern
+# ------------------------------------------------------------
+# The ScanMetrics of the running instrumented scan (see instrumented_scan), or None. Scans only
+# pay for timing while it is set.
+scan_metrics = None
+
+# Each pattern is also timed on its own over the first this many scanned bytes (per process),
+# since the time spent on one pattern cannot be told apart inside the combined regex
+pattern_sample_bytes = 16 * 1024 * 1024
+
+# Phases shorter than this are only added to the totals, not to the trace, so a scan of many
+# small files does not produce millions of trace events
+trace_min_seconds = 0.001
+
+
+# Wall time and count of each scan phase (e.g. 'git_clone', 'file_read', 'regex_match',
+# 'http_fetch'), counters (e.g. 'bytes_scanned'), and the matches and sampled time of each
+# pattern. Phases that run at the same time (in threads, worker processes or concurrent requests)
+# each add their own time, so phase totals can exceed the wall time. With trace, phases are also
+# kept as Chrome trace events, with one row per process and thread.
+class ScanMetrics:
+
+    def __init__(self, trace = False):
+        self.trace = trace
+        self.lock = threading.Lock()
+        self.started = perf_counter()
+        self.phases = {}            # phase: [seconds, count]
+        self.counters = {}
+        self.pattern_matches = {}
+        self.pattern_seconds = {}
+        self.sampled_bytes = 0
+        self.sample_budget = pattern_sample_bytes
+        self.events = []
+
+    def add_phase(self, phase, start, end, args = None):
+        with self.lock:
+            totals = self.phases.setdefault(phase, [0.0, 0])
+            totals[0] += end - start
+            totals[1] += 1
+            if self.trace and end - start >= trace_min_seconds:
+                self.events.append({'name': phase, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                                    'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args or {}})
+
+    def count(self, counter, value = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    # Count the matches of a {phi_type: [values]} dict
+    def count_matches(self, values):
+        with self.lock:
+            for phi_type, phi_values in values.items():
+                self.pattern_matches[phi_type] = self.pattern_matches.get(phi_type, 0) + len(phi_values)
+
+    # Time each of the matcher's patterns on its own over content, until the sample budget is spent
+    def sample_patterns(self, matcher, content):
+        if self.sample_budget <= 0 or not content:
+            return
+
+        regexes = matcher.pattern_bytes_regexes if isinstance(content, bytes) else matcher.pattern_regexes
+        seconds = {}
+        for phi_type, regex in regexes.items():
+            start = perf_counter()
+            for _ in regex.finditer(content):
+                pass
+            seconds[phi_type] = perf_counter() - start
+
+        with self.lock:
+            self.sample_budget -= len(content)
+            self.sampled_bytes += len(content)
+            for phi_type, phi_seconds in seconds.items():
+                self.pattern_seconds[phi_type] = self.pattern_seconds.get(phi_type, 0.0) + phi_seconds
+
+    # Take the metrics recorded so far, as a picklable dict, and start over. Worker processes
+    # return them with the results of each batch, and the parent process merges them.
+    def drain(self):
+        with self.lock:
+            drained = {'phases': self.phases, 'counters': self.counters, 'pattern_matches': self.pattern_matches,
+                       'pattern_seconds': self.pattern_seconds, 'sampled_bytes': self.sampled_bytes, 'events': self.events}
+            self.phases, self.counters, self.pattern_matches, self.pattern_seconds = {}, {}, {}, {}
+            self.sampled_bytes, self.events = 0, []
+
+        return drained
+
+    def merge(self, drained):
+        with self.lock:
+            for phase, (seconds, count) in drained['phases'].items():
+                totals = self.phases.setdefault(phase, [0.0, 0])
+                totals[0] += seconds
+                totals[1] += count
+            for totals, values in ((self.counters, drained['counters']), (self.pattern_matches, drained['pattern_matches']),
+                                   (self.pattern_seconds, drained['pattern_seconds'])):
+                for key, value in values.items():
+                    totals[key] = totals.get(key, 0) + value
+            self.sampled_bytes += drained['sampled_bytes']
+            self.events += drained['events']
+
+    # Machine-readable summary: phase seconds and counts, counters, and per pattern the matches
+    # and the seconds spent on the sampled bytes
+    def summary(self):
+        with self.lock:
+            phi_types = list(dict.fromkeys([*self.pattern_matches, *self.pattern_seconds]))
+            return {
+                'wall_seconds': perf_counter() - self.started,
+                'phases': {phase: {'seconds': seconds, 'count': count} for phase, (seconds, count) in self.phases.items()},
+                'counters': dict(self.counters),
+                'patterns': {phi_type: {'matches': self.pattern_matches.get(phi_type, 0),
+                                        'sampled_seconds': self.pattern_seconds.get(phi_type, 0.0)}
+                             for phi_type in phi_types},
+                'pattern_sampled_bytes': self.sampled_bytes,
+            }
+
+    def write_json(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
+
+    # Chrome trace event file, for chrome://tracing or https://ui.perfetto.dev
+    def write_trace(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+# Time a block as a phase of the instrumented scan, if any
+@contextlib.contextmanager
+def scan_phase(phase, **args):
+
+    metrics = scan_metrics
+    if metrics is None:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_phase(phase, start, perf_counter(), args)
+
+
+def count_scan_metric(counter, value = 1):
+    if scan_metrics is not None:
+        scan_metrics.count(counter, value)
+
+
+# Yield the items of an iterable, timing the production of each one as a phase (e.g. the steps
+# of os.walk, or the records of a git log stream), but not the work done on it
+def timed_iter(iterable, phase):
+
+    iterator = iter(iterable)
+    while True:
+        metrics = scan_metrics
+        start = perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if metrics is not None:
+            metrics.add_phase(phase, start, perf_counter())
+        yield item
+
+
+# Instrument the scans run in the block with a new ScanMetrics (yielded), and at the end write its
+# summary as JSON to metrics_output and its Chrome trace to trace_output. Inside an instrumented
+# scan, or without either output, the block runs as it is.
+@contextlib.contextmanager
+def instrumented_scan(metrics_output = None, trace_output = None):
+
+    global scan_metrics
+    if scan_metrics is not None or (metrics_output is None and trace_output is None):
+        yield scan_metrics
+        return
+
+    metrics = scan_metrics = ScanMetrics(trace = trace_output is not None)
+    try:
+        yield metrics
+    finally:
+        scan_metrics = None
+        if metrics_output is not None:
+            metrics.write_json(metrics_output)
+        if trace_output is not None:
+            metrics.write_trace(trace_output)
+
+
+# ------------------------------------------------------------
+# Known non-PHI values (e.g. synthetic test member IDs) that are never reported
+# ------------------------------------------------------------
+# Values are held in hashed sets per pattern type, plus one set ('*') that applies to every type,
+# so each match is checked in constant time however many values are listed.
+class PhiAllowlist:
+
+    # values: an iterable of values for every pattern type, or {phi_type: iterable of values}
+    def __init__(self, values = ()):
+        if not isinstance(values, dict):
+            values = {'*': values}
+        self.values = {phi_type: frozenset(map(str, type_values)) for phi_type, type_values in values.items()}
+        self.values = {phi_type: type_values for phi_type, type_values in self.values.items() if type_values}
+
+    # Allowlist read from text files with one value per line. A line 'phi_type,value' only applies
+    # to that pattern type; a line with a value alone (or '*,value') applies to every type.
+    @classmethod
+    def from_files(cls, *file_paths):
+        values = {}
+        for file_path in file_paths:
+            with open(file_path) as file:
+                for line in file:
+                    phi_type, _, value = line.strip().rpartition(',')
+                    if value:
+                        values.setdefault(phi_type or '*', []).append(value)
+
+        return cls(values)
+
+    def __len__(self):
+        return sum(len(type_values) for type_values in self.values.values())
+
+    # Values never reported for a pattern type, as two sets: its own values and the values for
+    # every type. The sets are shared, never merged or copied, so a large allowlist is held once.
+    def type_value_sets(self, phi_type):
+        return self.values.get(phi_type, frozenset()), self.values.get('*', frozenset())
+
+    # Digest of every value, to invalidate cached findings when the allowlist changes
+    @functools.cached_property
+    def fingerprint(self):
+        digest = hashlib.sha256()
+        for phi_type in sorted(self.values):
+            for value in sorted(self.values[phi_type]):
+                digest.update(f'{phi_type}\0{value}\0'.encode())
+
+        return digest.hexdigest()
+
+
+# An allowlist from a list of values, a {phi_type: values} dict, or a PhiAllowlist; None when empty
+def as_allowlist(known_non_phi = None):
+
+    if known_non_phi is None or isinstance(known_non_phi, PhiAllowlist):
+        allowlist = known_non_phi
+    else:
+        allowlist = PhiAllowlist(known_non_phi)
+
+    return allowlist if allowlist else None
+
+
+# Scans text for every PHI pattern in a single pass. The patterns are combined into one
+# alternation of named groups, and when the characters every pattern starts with are known, a
+# lookahead on them lets the regex engine skip all other positions. Where several patterns match
+# at the same position, the first one in `patterns` wins, and matches do not overlap. Matches of
+# values in the allowlist are dropped as they are found, before any PhiMatch is built.
+class PhiMatcher:
+
+    def __init__(self, phi_patterns, allowlist = None):
+        self.phi_types = list(phi_patterns)
+        self.group_types = {f'phi_{number}': phi_type for number, phi_type in enumerate(self.phi_types)}
+        self.group_allowed = {group: allowlist.type_value_sets(phi_type) if allowlist else (frozenset(), frozenset())
+                              for group, phi_type in self.group_types.items()}
+
+        combined = '|'.join(f'(?P<phi_{number}>{scoped_flags_pattern(pattern)})'
+                            for number, pattern in enumerate(phi_patterns.values()))
+        first_characters = [pattern_first_characters(pattern) for pattern in phi_patterns.values()]
+        if all(first_characters):
+            combined = f'(?=[{"".join(first_characters)}])(?:{combined})'
+
+        self.regex = re.compile(combined)
+        self.bytes_regex = re.compile(combined.encode('ISO 8859-1'))
+
+        # Each pattern on its own, only used to time the patterns of an instrumented scan
+        self.pattern_regexes = {phi_type: re.compile(pattern) for phi_type, pattern in phi_patterns.items()}
+        self.pattern_bytes_regexes = {phi_type: re.compile(pattern.encode('ISO 8859-1'))
+                                      for phi_type, pattern in phi_patterns.items()}
+
+    # Typed matches in text (str) or raw file content (bytes)
+    def finditer(self, content):
+        metrics = scan_metrics
+        if metrics is not None:
+            metrics.count('bytes_scanned', len(content))
+            metrics.sample_patterns(self, content)
+            start = perf_counter()
+
+        if isinstance(content, bytes):
+            for match in self.bytes_regex.finditer(content):
+                value = match.group().decode('ISO 8859-1')
+                type_allowed, all_types_allowed = self.group_allowed[match.lastgroup]
+                if value not in type_allowed and value not in all_types_allowed:
+                    yield PhiMatch(self.group_types[match.lastgroup], value, match.start(), match.end())
+        else:
+            for match in self.regex.finditer(content):
+                value = match.group()
+                type_allowed, all_types_allowed = self.group_allowed[match.lastgroup]
+                if value not in type_allowed and value not in all_types_allowed:
+                    yield PhiMatch(self.group_types[match.lastgroup], value, match.start(), match.end())
+
+        if metrics is not None:
+            metrics.add_phase('regex_match', start, perf_counter())
+
+    # Typed matches in a binary file object, read chunk by chunk. A match that starts in the last
+    # overlap_bytes of the data read so far is left for the next chunk, which is scanned from
+    # where the previous scan stopped, so no match is lost at a boundary or reported twice.
+    def scan_stream(self, file, chunk_bytes = scan_chunk_bytes, overlap_bytes = scan_overlap_bytes):
+        buffer, buffer_offset, scan_from = b'', 0, 0
+        metrics = scan_metrics
+
+        while True:
+            if metrics is not None:
+                read_start = perf_counter()
+            chunk = file.read(chunk_bytes)
+            if metrics is not None:
+                metrics.add_phase('file_read', read_start, perf_counter())
+                metrics.count('bytes_scanned', len(chunk))
+                metrics.sample_patterns(self, chunk)
+                match_start = perf_counter()
+            at_end = not chunk
+            buffer += chunk
+
+            limit = len(buffer) if at_end else len(buffer) - overlap_bytes
+            next_scan = max(scan_from, limit)
+            for match in self.bytes_regex.finditer(buffer, scan_from):
+                if match.start() >= limit:
+                    next_scan = match.start()
+                    break
+                value = match.group().decode('ISO 8859-1')
+                type_allowed, all_types_allowed = self.group_allowed[match.lastgroup]
+                if value not in type_allowed and value not in all_types_allowed:
+                    yield PhiMatch(self.group_types[match.lastgroup], value,
+                                   buffer_offset + match.start(), buffer_offset + match.end())
+                next_scan = max(match.end(), limit)
+
+            if metrics is not None:
+                metrics.add_phase('regex_match', match_start, perf_counter())
+
+            if at_end:
+                return
+
+            # Keep overlap_bytes before the next scan position as context for \b and lookbehinds
+            cut = max(0, next_scan - overlap_bytes)
+            buffer = buffer[cut:]
+            buffer_offset += cut
+            scan_from = next_scan - cut
+
+    # Findings as [{phi_type: [values]}, ...], in the order of the patterns (then any other types,
+    # e.g. unscanned_archive_type)
+    def group_findings(self, matches):
+        values = {}
+        for match in matches:
+            values.setdefault(match.phi_type, []).append(match.value)
+
+        if scan_metrics is not None:
+            scan_metrics.count_matches(values)
+
+        phi_types = self.phi_types + [phi_type for phi_type in values if phi_type not in self.phi_types]
+        return [{phi_type: values[phi_type]} for phi_type in phi_types if phi_type in values]
+
+    def findings(self, content):
+        return self.group_findings(self.finditer(content))
+
+    # Combine the findings of several texts into one findings list
+    def merge_findings(self, findings_list):
+        values = {}
+        for findings in findings_list:
+            for finding in findings:
+                for phi_type, phi_values in finding.items():
+                    values.setdefault(phi_type, []).extend(phi_values)
+
+        return [{phi_type: values[phi_type]} for phi_type in self.phi_types if phi_type in values]
+
+
+@functools.lru_cache(maxsize=8)
+def compile_phi_matcher(pattern_items, allowlist):
+    return PhiMatcher(dict(pattern_items), allowlist)
+
+
+# The compiled matcher for a set of patterns (the `patterns` above by default) and allowlist
+def get_phi_matcher(phi_patterns = None, allowlist = None):
+    return compile_phi_matcher(tuple((phi_patterns or patterns).items()), allowlist)
+
+
+# ------------------------------------------------------------
+# Archives, compressed files and binary files
+# ------------------------------------------------------------
+# Decompression bomb limits, per scanned file: total bytes decompressed, ratio of decompressed to
+# compressed bytes (checked once past archive_ratio_min_bytes), and nesting depth of archives
+archive_max_bytes = 1024 * 1024 * 1024
+archive_max_ratio = 100
+archive_ratio_min_bytes = 1024 * 1024
+archive_max_depth = 3
+
+# Leading bytes read to identify content. Content that is not an archive and has a NUL byte in
+# them is binary, and is skipped.
+sniff_bytes = 8192
+
+# Zip archives need random access: ones read from a stream (a git blob, or a member of another
+# archive) are buffered in memory up to this size, and in a temporary file beyond it
+archive_spool_bytes = 64 * 1024 * 1024
+
+# Finding type reported for a file that could not be fully scanned (a limit was exceeded, or the
+# archive is unreadable or encrypted), so that it is reviewed manually
+unscanned_archive_type = 'archive_not_fully_scanned'
+
+
+class ArchiveLimitExceeded(Exception):
+    pass
+
+
+# Bytes decompressed, and compressed bytes consumed, while scanning one file
+class DecompressionBudget:
+
+    def __init__(self):
+        self.decompressed = 0
+        self.compressed = 0
+
+    def add(self, decompressed = 0, compressed = 0):
+        self.decompressed += decompressed
+        self.compressed += compressed
+
+        if self.decompressed > archive_max_bytes:
+            raise ArchiveLimitExceeded(f'more than {archive_max_bytes} bytes decompressed')
+        if self.decompressed > archive_ratio_min_bytes and self.decompressed > archive_max_ratio * self.compressed:
+            raise ArchiveLimitExceeded(f'compression ratio over {archive_max_ratio}')
+
+
+# Counts the bytes read from a stream against a budget: as decompressed output, or as compressed input
+class BudgetReader:
+
+    def __init__(self, stream, budget, compressed = False):
+        self.stream = stream
+        self.budget = budget
+        self.compressed = compressed
+
+    def read(self, size = -1):
+        data = self.stream.read(size)
+        if self.compressed:
+            self.budget.add(compressed=len(data))
+        else:
+            self.budget.add(decompressed=len(data))
+        return data
+
+
+# A stream whose leading bytes were already read: returns them again, then the rest of the stream
+class PrefixedReader:
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size = -1):
+        if not self.prefix:
+            return self.stream.read(size)
+
+        if size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b''
+        else:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+# 'zip' (including .xlsx), 'gzip', 'bz2', 'tar', 'binary' or 'text', from the leading bytes of content
+def content_kind(head):
+
+    if head.startswith((b'PK\x03\x04', b'PK\x05\x06')):
+        return 'zip'
+    if head.startswith(b'\x1f\x8b'):
+        return 'gzip'
+    if head.startswith(b'BZh') and head[4:10] == b'\x31\x41\x59\x26\x53\x59':
+        return 'bz2'
+    if head[257:262] == b'ustar':
+        return 'tar'
+    if b'\0' in head:
+        return 'binary'
+
+    return 'text'
+
+
+# PHI matches in a binary file object, identified by its content rather than its name. Text is
+# scanned in chunks; gzip, bz2, tar and zip (including .xlsx) content is decompressed as a stream
+# and every member is scanned the same way, nothing is extracted to disk; other binary content is
+# skipped. A file that hits a decompression limit or cannot be read as an archive gets an
+# unscanned_archive_type match, after any matches found before that point.
+def scan_content(matcher, file, depth = 0, budget = None):
+
+    if budget is None:
+        count_scan_metric('files_scanned')
+        try:
+            yield from scan_content(matcher, file, depth, DecompressionBudget())
+        except ArchiveLimitExceeded as exception:
+            yield PhiMatch(unscanned_archive_type, str(exception), 0, 0)
+        except (zipfile.BadZipFile, zipfile.LargeZipFile, tarfile.TarError, EOFError, OSError, RuntimeError) as exception:
+            yield PhiMatch(unscanned_archive_type, f'unreadable archive: {exception}', 0, 0)
+        return
+
+    head = file.read(sniff_bytes)
+    kind = content_kind(head)
+    content = PrefixedReader(head, file)
+
+    if kind == 'text':
+        yield from matcher.scan_stream(content)
+        return
+    if kind == 'binary':
+        return
+    if depth >= archive_max_depth:
+        raise ArchiveLimitExceeded(f'archives nested more than {archive_max_depth} deep')
+
+    if kind in ('gzip', 'bz2'):
+        compressed = BudgetReader(content, budget, compressed=True)
+        stream = gzip.GzipFile(fileobj=compressed) if kind == 'gzip' else bz2.BZ2File(compressed)
+        yield from scan_content(matcher, BudgetReader(stream, budget), depth + 1, budget)
+
+    elif kind == 'tar':
+        # Members of a tar are stored, not compressed; a compressed tar was counted by the layer above
+        with tarfile.open(fileobj=content, mode='r|') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield from scan_content(matcher, archive.extractfile(member), depth + 1, budget)
+
+    else:
+        if depth == 0 and getattr(file, 'seekable', lambda: False)():
+            file.seek(0)
+            archive_file = file
+        else:
+            archive_file = tempfile.SpooledTemporaryFile(max_size=archive_spool_bytes)
+            shutil.copyfileobj(content, archive_file, scan_chunk_bytes)
+            archive_file.seek(0)
+
+        try:
+            with zipfile.ZipFile(archive_file) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        budget.add(compressed=info.compress_size)
+                        with archive.open(info) as member:
+                            yield from scan_content(matcher, BudgetReader(member, budget), depth + 1, budget)
+        finally:
+            if archive_file is not file:
+                archive_file.close()
+
+
+# Function to scan file for PHI, reading it in chunks
+def scan_file_for_phi(file_path, phi_patterns = None, allowlist = None):
+
+    matcher = get_phi_matcher(phi_patterns, allowlist)
+    with open(file_path, 'rb') as file:
+        return matcher.group_findings(scan_content(matcher, file))
+
+
+# Function to scan text (or the raw bytes of a file, which may be an archive) for PHI
+def scan_text_for_phi(content, phi_patterns = None, allowlist = None):
+
+    matcher = get_phi_matcher(phi_patterns, allowlist)
+    if isinstance(content, bytes):
+        return matcher.group_findings(scan_content(matcher, io.BytesIO(content)))
+
+    return matcher.findings(content)
+
+
+# ------------------------------------------------------------
+# Functions to scan batches of files in a process pool
+# ------------------------------------------------------------
+# Files are grouped into batches of up to this many bytes (or files), so small files share one
+# round trip to a worker process
+scan_batch_bytes = 8 * 1024 * 1024
+scan_batch_files = 256
+
+
+# Group (item, size) pairs into batches of items
+def size_batches(sized_items, batch_bytes = scan_batch_bytes, batch_files = scan_batch_files):
+
+    batch, batch_size = [], 0
+    for item, size in sized_items:
+        if batch and (batch_size + size > batch_bytes or len(batch) >= batch_files):
+            yield batch
+            batch, batch_size = [], 0
+        batch.append(item)
+        batch_size += size
+
+    if batch:
+        yield batch
+
+
+# Settings read by the scan worker processes, which are sent to each worker as they are set in
+# this process
+worker_settings = ('scan_chunk_bytes', 'scan_overlap_bytes', 'pattern_sample_bytes', 'trace_min_seconds',
+                   'archive_max_bytes', 'archive_max_ratio', 'archive_ratio_min_bytes', 'archive_max_depth',
+                   'sniff_bytes', 'archive_spool_bytes')
+
+
+# Process pool for batch scans. The allowlist is sent to each worker process once, when it
+# starts, rather than with every batch. In an instrumented scan, each worker records its own
+# ScanMetrics. Workers are started by a forkserver rather than forked: organization_phi_scan
+# runs scans in threads, and a process forked while another thread holds a lock (in logging,
+# SQLite or a requests pool) can deadlock.
+def scan_process_pool(workers, allowlist = None):
+    metrics_trace = scan_metrics.trace if scan_metrics is not None else None
+    settings = {name: globals()[name] for name in worker_settings}
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                               initializer=init_scan_worker, initargs=(allowlist, metrics_trace, settings))
+
+
+worker_allowlist = None
+
+
+def init_scan_worker(allowlist, metrics_trace = None, settings = None):
+    global worker_allowlist, scan_metrics
+    globals().update(settings or {})
+    worker_allowlist = allowlist
+    scan_metrics = ScanMetrics(metrics_trace) if metrics_trace is not None else None
+
+
+# Worker functions: findings for each file path, or each content, of a batch, and the worker's
+# drained metrics (None unless the scan is instrumented)
+def scan_file_batch(file_paths, phi_patterns):
+    findings = [scan_file_for_phi(file_path, phi_patterns, worker_allowlist) for file_path in file_paths]
+    return findings, scan_metrics.drain() if scan_metrics is not None else None
+
+
+def scan_content_batch(contents, phi_patterns):
+    findings = [scan_text_for_phi(content, phi_patterns, worker_allowlist) for content in contents]
+    return findings, scan_metrics.drain() if scan_metrics is not None else None
+
+
+# Add a worker's drained metrics to the instrumented scan
+def merge_worker_metrics(drained):
+    if drained is not None and scan_metrics is not None:
+        scan_metrics.merge(drained)
+
 
-    # Read the file content
-    with open(file_path, 'r', encoding='ISO 8859-1') as file:
-        content = file.read()
+# Like executor.map, but submits at most max_pending batches ahead of the results being consumed,
+# so a large stream of batches (e.g. blob contents) is never all in memory. Results are yielded
+# in input order.
+def ordered_pool_map(executor, function, batches, *args, max_pending = 16):
 
-    # Dictionary to hold results
-    findings = []
+    pending = deque()
 
-    # Scan for each pattern
-    for phi_type, pattern in patterns.items():
-        matches = re.findall(pattern, content)
-        if matches:
-            findings.append({phi_type: matches})
+    for batch in batches:
+        pending.append(executor.submit(function, batch, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
 
-    return findings
+    while pending:
+        yield pending.popleft().result()
 
 
 # ------------------------------------------------------------
 # # Function to scan all files in a directory for PHI
 # ------------------------------------------------------------  
-def scan_directory_for_phi(directory_path):
+# Yields (file_path, findings) for every scanned file, in sorted walk order. With workers > 1,
+# batches of files are scanned in a process pool.
+def iter_directory_phi(directory_path, workers = 1, allowlist = None):
+
+    def scan_file_paths():
+        for root, dirs, files in timed_iter(os.walk(directory_path), 'directory_walk'):
+            dirs.sort()
+            for file_name in sorted(files):
+                if file_name.endswith(scan_file_suffixes + scan_archive_suffixes):
+                    yield os.path.join(root, file_name)
+
+    if workers <= 1:
+        for file_path in scan_file_paths():
+            yield file_path, scan_file_for_phi(file_path, allowlist=allowlist)
+        return
+
+    # The tree is walked as batches are submitted, not up front; the paths of each submitted batch
+    # are kept until its findings come back
+    sized_paths = ((file_path, os.path.getsize(file_path)) for file_path in scan_file_paths())
+    batch_paths = deque()
+
+    def path_batches():
+        for batch in size_batches(sized_paths):
+            batch_paths.append(batch)
+            yield batch
+
+    with scan_process_pool(workers, allowlist) as executor:
+        for batch_findings, batch_metrics in ordered_pool_map(executor, scan_file_batch, path_batches(), patterns, max_pending=2*workers):
+            merge_worker_metrics(batch_metrics)
+            yield from zip(batch_paths.popleft(), batch_findings)
+
+
+def scan_directory_for_phi(directory_path, workers = 1, allowlist = None):
 
     results = {}
 
     # Scan each file in the directory
-    for root, _, files in os.walk(directory_path):
-        for file_name in files:
-            if (file_name.endswith('.py') |\
-               file_name.endswith('.R') |\
-               file_name.endswith('.r') |\
-               file_name.endswith('.hql') |\
-               file_name.endswith('.sql') |\
-               file_name.endswith('.HQL') |\
-               file_name.endswith('.SQL') |\
-               file_name.endswith('.md') |\
-               file_name.endswith('.txt') |\
-               file_name.endswith('.csv')):
-                file_path = os.path.join(root, file_name)
-                findings = scan_file_for_phi(file_path)
-                if findings:
-                    results[file_path] = findings
+    for file_path, findings in iter_directory_phi(directory_path, workers, allowlist):
+        if findings:
+            results[file_path] = findings
 
     return results
   
@@ -114,9 +970,9 @@ def scan_directory_for_phi(directory_path):
 # ------------------------------------------------------------
 # Function to identify all remote feature branches of a GitHub repository
 # ------------------------------------------------------------
-def get_feature_branches():
+def get_feature_branches(repo_directory = '.'):
     # Run the git command and capture the output
-    result = subprocess.run(['git', 'ls-remote', '--heads', 'origin'], stdout=subprocess.PIPE, text=True)
+    result = subprocess.run(['git', '-C', repo_directory, 'ls-remote', '--heads', 'origin'], stdout=subprocess.PIPE, text=True)
 
     # Split the output into lines
     lines = result.stdout.splitlines()
@@ -135,6 +991,611 @@ def get_feature_branches():
 
     return feature_branches
   
+
+# ------------------------------------------------------------
+# Functions to scan the git blobs of all branches, each unique blob once
+# ------------------------------------------------------------
+# Reads blob contents through one long-lived `git cat-file --batch` process
+class GitBlobReader:
+
+    def __init__(self, repo_directory):
+        self.process = subprocess.Popen(['git', '-C', repo_directory, 'cat-file', '--batch'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # Return a blob's content as a file object (a GitBlob), or None if the object is missing
+    def open(self, blob_sha):
+        self.process.stdin.write(f'{blob_sha}\n'.encode())
+        self.process.stdin.flush()
+
+        # Header: '<sha> <type> <size>', or '<sha> missing'
+        with scan_phase('file_read'):
+            header = self.process.stdout.readline().split()
+        if header[-1] == b'missing':
+            return None
+
+        return GitBlob(self.process.stdout, int(header[2]))
+
+    # Return the content of a blob, or None if the object is missing
+    def read(self, blob_sha):
+        blob = self.open(blob_sha)
+        if blob is None:
+            return None
+
+        with blob:
+            return blob.read()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# A blob's content on the `git cat-file --batch` output. It must be closed before the next blob is
+# requested; closing skips any unread content.
+class GitBlob:
+
+    def __init__(self, stdout, size):
+        self.stdout = stdout
+        self.size = size
+        self.remaining = size
+
+    def read(self, size = -1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stdout.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        while self.remaining:
+            self.read(scan_chunk_bytes)
+        self.stdout.read(1)  # trailing newline
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Map each scanned blob SHA to the (branch, path) entries that reference it, across all branch heads
+def get_branch_blobs(repo_directory, branches, ref_prefix='refs/heads/'):
+
+    blob_paths = {}
+
+    for branch in branches:
+        with scan_phase('git_list_files', branch=branch):
+            result = subprocess.run(['git', '-C', repo_directory, 'ls-tree', '-r', '-z', f'{ref_prefix}{branch}'],
+                                    stdout=subprocess.PIPE, check=True)
+
+        # Entries: '<mode> <type> <sha>\t<path>', NUL-terminated
+        for entry in result.stdout.split(b'\0'):
+            if not entry:
+                continue
+            info, path = entry.split(b'\t', 1)
+            _, object_type, blob_sha = info.split()
+            path = path.decode('utf-8', 'surrogateescape')
+
+            if object_type == b'blob' and path.endswith(scan_file_suffixes + scan_archive_suffixes):
+                blob_paths.setdefault(blob_sha.decode(), []).append((branch, path))
+
+    return blob_paths
+
+
+# Head commit of each branch
+def get_branch_heads(repo_directory, ref_prefix='refs/heads/'):
+
+    result = subprocess.run(['git', '-C', repo_directory, 'for-each-ref', '--format=%(objectname) %(refname)', ref_prefix],
+                            stdout=subprocess.PIPE, text=True, check=True)
+
+    return {ref[len(ref_prefix):]: commit_sha for commit_sha, ref in (line.split(' ', 1) for line in result.stdout.splitlines())}
+
+
+# Scan the files of all branch heads without checking them out. Each unique blob is scanned once
+# and its findings are reported for every branch and path that contains it. With a scan_cache
+# (a PhiScanCache), branches whose head has not moved since the last scan are not listed again,
+# and only blobs that were never scanned before are read.
+# Yields (branch, path, findings) for every file with findings: first the files whose blob was
+# scanned in an earlier run, then the others as their blob is scanned, then the files of the
+# unchanged branches.
+def iter_branch_blob_phi(repo_directory, branches, ref_prefix='refs/heads/', workers = 1,
+                         scan_cache = None, repo_name = None, allowlist = None):
+
+    repo_name = repo_name or repo_directory
+    branch_heads = get_branch_heads(repo_directory, ref_prefix)
+
+    if scan_cache is None:
+        changed_branches = branches
+    else:
+        scanned_commits = scan_cache.branch_commits(repo_name)
+        changed_branches = [branch for branch in branches if scanned_commits.get(branch) != branch_heads.get(branch)]
+
+    blob_paths = get_branch_blobs(repo_directory, changed_branches, ref_prefix)
+    cached_findings = scan_cache.blob_findings(blob_paths) if scan_cache is not None else {}
+    new_blobs = [blob_sha for blob_sha in blob_paths if blob_sha not in cached_findings]
+
+    print(f'Scanning {len(new_blobs)} new unique files across {len(changed_branches)} changed remote branches '
+          f'(of {len(branches)}) for potential PHI...')
+
+    # {branch: [(path, blob_sha)]} of the files with findings
+    flagged_paths = {}
+
+    def flagged_files(blob_sha, findings):
+        for branch, path in blob_paths[blob_sha]:
+            flagged_paths.setdefault(branch, []).append((path, blob_sha))
+            yield branch, path, findings
+
+    for blob_sha, findings in cached_findings.items():
+        if findings:
+            yield from flagged_files(blob_sha, findings)
+
+    new_findings = {}
+    with GitBlobReader(repo_directory) as reader:
+        for blob_sha, findings in iter_blob_phi(reader, new_blobs, workers, allowlist):
+            if scan_cache is not None:
+                new_findings[blob_sha] = findings
+                if len(new_findings) >= scan_cache_batch_blobs:
+                    scan_cache.add_blob_findings(new_findings)
+                    new_findings = {}
+            if findings:
+                yield from flagged_files(blob_sha, findings)
+
+    # Branch heads are only recorded once all of their blobs are scanned
+    if scan_cache is not None:
+        scan_cache.add_blob_findings(new_findings)
+        scan_cache.update_branches(repo_name, {branch: branch_heads.get(branch) for branch in changed_branches},
+                                   flagged_paths, branches)
+
+        # Unchanged branches: the files with findings as of their last scan
+        for branch in branches:
+            if branch not in changed_branches:
+                branch_paths = scan_cache.branch_flagged_paths(repo_name, branch)
+                branch_findings = scan_cache.blob_findings({blob_sha for _, blob_sha in branch_paths})
+                for path, blob_sha in branch_paths:
+                    yield branch, path, branch_findings[blob_sha]
+
+
+# {branch: {path: findings}} of the files with findings of all branch heads (see iter_branch_blob_phi)
+def scan_branch_blobs_for_phi(repo_directory, branches, ref_prefix='refs/heads/', workers = 1,
+                              scan_cache = None, repo_name = None, allowlist = None):
+
+    results = {}
+    for branch, path, findings in iter_branch_blob_phi(repo_directory, branches, ref_prefix, workers,
+                                                       scan_cache, repo_name, allowlist):
+        results.setdefault(branch, {})[path] = findings
+
+    return {branch: results[branch] for branch in branches if branch in results}
+
+
+# Yields (blob_sha, findings) for every blob that exists. Blobs are streamed from git and scanned
+# chunk by chunk. With workers > 1, blobs up to one chunk are instead read whole and scanned in
+# batches in a process pool, while the next blobs are read from git.
+def iter_blob_phi(reader, blob_shas, workers = 1, allowlist = None):
+
+    matcher = get_phi_matcher(allowlist=allowlist)
+
+    if workers <= 1:
+        for blob_sha in blob_shas:
+            blob = reader.open(blob_sha)
+            if blob is not None:
+                with blob:
+                    yield blob_sha, matcher.group_findings(scan_content(matcher, blob))
+        return
+
+    # Large blobs are scanned in this process as they come up
+    streamed_findings = deque()
+
+    def small_blobs():
+        for blob_sha in blob_shas:
+            blob = reader.open(blob_sha)
+            if blob is None:
+                continue
+            with blob:
+                if blob.size <= scan_chunk_bytes:
+                    with scan_phase('file_read'):
+                        content = blob.read()
+                    yield (blob_sha, content), blob.size
+                else:
+                    streamed_findings.append((blob_sha, matcher.group_findings(scan_content(matcher, blob))))
+
+    batches = size_batches(small_blobs())
+    batch_shas = deque()
+
+    def content_batches():
+        for batch in batches:
+            batch_shas.append([blob_sha for blob_sha, _ in batch])
+            yield [content for _, content in batch]
+
+    with scan_process_pool(workers, allowlist) as executor:
+        for batch_findings, batch_metrics in ordered_pool_map(executor, scan_content_batch, content_batches(), patterns, max_pending=2*workers):
+            merge_worker_metrics(batch_metrics)
+            yield from zip(batch_shas.popleft(), batch_findings)
+            while streamed_findings:
+                yield streamed_findings.popleft()
+
+    while streamed_findings:
+        yield streamed_findings.popleft()
+
+
+# ------------------------------------------------------------
+# Functions to scan every file version in the history of all branches
+# ------------------------------------------------------------
+# Split a binary stream on NUL bytes, reading it in chunks
+def iter_nul_tokens(stream, chunk_bytes = 1024 * 1024):
+
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_bytes)
+        if not chunk:
+            break
+        tokens = (pending + chunk).split(b'\0')
+        pending = tokens.pop()
+        yield from tokens
+
+    if pending:
+        yield pending
+
+
+# Streams (commit, author_date, author_email, path, blob_sha) for every scanned file version that a
+# commit reachable from any branch adds or modifies, from `git log --raw`. Merge commits only
+# report files whose merged content differs from every parent (i.e. conflict resolutions).
+def iter_history_changes(repo_directory):
+
+    process = subprocess.Popen(['git', '-C', repo_directory, 'log', '--branches', '--raw', '-c', '--no-abbrev',
+                                '--no-renames', '-z', '--format=commit:%H%x09%aI%x09%ae'],
+                               stdout=subprocess.PIPE)
+    tokens = iter_nul_tokens(process.stdout)
+    commit = None
+
+    for token in tokens:
+        token = token.lstrip(b'\n')
+
+        if token.startswith(b'commit:'):
+            commit = token[len(b'commit:'):].decode('utf-8', 'replace').split('\t')
+
+        # ':<modes> <blob shas> <status>' for one path per parent, '::...' for a merge with 2 parents
+        elif token.startswith(b':'):
+            path = next(tokens).decode('utf-8', 'surrogateescape')
+            fields = token.split()
+            parents = len(fields[0]) - len(fields[0].lstrip(b':'))
+            mode, blob_sha = fields[parents], fields[2 * parents + 1].decode()
+
+            if mode.startswith(b'100') and blob_sha.strip('0') and path.endswith(scan_file_suffixes + scan_archive_suffixes):
+                yield commit[0], commit[1], commit[2], path, blob_sha
+
+    process.wait()
+
+
+# Yields (commit, author_date, author_email, path, findings) for every commit and path that
+# introduced a file version with potential PHI, over the whole history of all branches. Each
+# distinct blob is scanned once, as the log streams by; only the SHAs seen so far and the
+# findings of flagged blobs are kept in memory.
+def iter_history_phi(repo_directory, workers = 1, scan_cache = None, allowlist = None):
+
+    seen_blobs = set()
+    introductions = {}        # blob_sha: [(commit, author_date, author_email, path)], while being scanned
+    flagged_blobs = {}        # blob_sha: findings
+    scanned = deque()         # (blob_sha, findings, newly scanned)
+    reintroduced = deque()    # (commit, author_date, author_email, path, findings)
+
+    def new_blobs():
+        for commit, author_date, author_email, path, blob_sha in timed_iter(iter_history_changes(repo_directory), 'git_log'):
+            introduction = (commit, author_date, author_email, path)
+
+            if blob_sha in introductions:
+                introductions[blob_sha].append(introduction)
+            elif bytes.fromhex(blob_sha) in seen_blobs:
+                if blob_sha in flagged_blobs:
+                    reintroduced.append(introduction + (flagged_blobs[blob_sha],))
+            else:
+                seen_blobs.add(bytes.fromhex(blob_sha))
+                introductions[blob_sha] = [introduction]
+
+                cached = scan_cache.blob_findings([blob_sha]) if scan_cache is not None else {}
+                if blob_sha in cached:
+                    scanned.append((blob_sha, cached[blob_sha], False))
+                else:
+                    yield blob_sha
+
+    def resolved():
+        new_findings = {}
+        while scanned:
+            blob_sha, findings, newly_scanned = scanned.popleft()
+            if newly_scanned:
+                new_findings[blob_sha] = findings
+            if findings:
+                flagged_blobs[blob_sha] = findings
+                for introduction in introductions[blob_sha]:
+                    yield introduction + (findings,)
+            del introductions[blob_sha]
+
+        while reintroduced:
+            yield reintroduced.popleft()
+
+        if scan_cache is not None and new_findings:
+            scan_cache.add_blob_findings(new_findings)
+
+    with GitBlobReader(repo_directory) as reader:
+        for blob_sha, findings in iter_blob_phi(reader, new_blobs(), workers, allowlist):
+            scanned.append((blob_sha, findings, True))
+            yield from resolved()
+
+    yield from resolved()
+
+
+# ------------------------------------------------------------
+# Persistent scan cache, so repeated scans only read new content
+# ------------------------------------------------------------
+scan_cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'github_phi_scanning', 'scan_cache.sqlite')
+
+# Findings of newly scanned blobs are committed to the cache in batches of this many blobs, so an
+# interrupted scan keeps the work done up to its last batch
+scan_cache_batch_blobs = 1000
+
+
+# SQLite cache of the findings of every scanned blob (by SHA, so shared by all repos and branches),
+# and of the last scanned head commit and flagged files of every branch. The cache is cleared
+# when the PHI patterns, the allowlist or the scanned file types change. Concurrent repository scans each open their
+# own PhiScanCache on the same file; writes wait for each other (WAL journal, busy timeout).
+class PhiScanCache:
+
+    def __init__(self, path = scan_cache_path, phi_patterns = None, allowlist = None):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS blob_findings (blob_sha TEXT PRIMARY KEY, findings TEXT);
+            CREATE TABLE IF NOT EXISTS branch_scans (repo TEXT, branch TEXT, commit_sha TEXT, PRIMARY KEY (repo, branch));
+            CREATE TABLE IF NOT EXISTS branch_flagged_paths (repo TEXT, branch TEXT, path TEXT, blob_sha TEXT);
+            CREATE INDEX IF NOT EXISTS branch_flagged_paths_branch ON branch_flagged_paths (repo, branch);
+            CREATE TABLE IF NOT EXISTS http_scans (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, scan TEXT);
+        ''')
+
+        fingerprint = self.scan_fingerprint(phi_patterns or patterns, allowlist)
+        stored = self.connection.execute("SELECT value FROM settings WHERE key = 'fingerprint'").fetchone()
+        if stored is None or stored[0] != fingerprint:
+            with self.connection:
+                for table in ['blob_findings', 'branch_scans', 'branch_flagged_paths', 'http_scans']:
+                    self.connection.execute(f'DELETE FROM {table}')
+                self.connection.execute("INSERT OR REPLACE INTO settings VALUES ('fingerprint', ?)", (fingerprint,))
+
+    # Everything that changes the findings of a blob or the files listed for a branch
+    @staticmethod
+    def scan_fingerprint(phi_patterns, allowlist = None):
+        settings = {'patterns': list(phi_patterns.items()), 'file_suffixes': scan_file_suffixes,
+                    'archives': [scan_archive_suffixes, archive_max_bytes, archive_max_ratio, archive_max_depth]}
+        if allowlist:
+            settings['allowlist'] = allowlist.fingerprint
+        return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+    # {blob_sha: findings} of the given blobs that were scanned before
+    def blob_findings(self, blob_shas):
+        blob_shas = list(blob_shas)
+        findings = {}
+        for start in range(0, len(blob_shas), 500):
+            batch = blob_shas[start:start + 500]
+            rows = self.connection.execute(
+              f'SELECT blob_sha, findings FROM blob_findings WHERE blob_sha IN ({",".join("?" * len(batch))})', batch)
+            findings.update((blob_sha, json.loads(blob_findings)) for blob_sha, blob_findings in rows)
+
+        return findings
+
+    def add_blob_findings(self, blob_findings):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO blob_findings VALUES (?, ?)',
+                                        ((blob_sha, json.dumps(findings)) for blob_sha, findings in blob_findings.items()))
+
+    # {branch: head commit at the last scan}
+    def branch_commits(self, repo):
+        return dict(self.connection.execute('SELECT branch, commit_sha FROM branch_scans WHERE repo = ?', (repo,)))
+
+    # [(path, blob_sha)] of the files with findings at the last scan of a branch
+    def branch_flagged_paths(self, repo, branch):
+        return self.connection.execute('SELECT path, blob_sha FROM branch_flagged_paths WHERE repo = ? AND branch = ? ORDER BY rowid',
+                                       (repo, branch)).fetchall()
+
+    # Record newly scanned branch heads and their flagged files, and forget branches that no longer exist
+    def update_branches(self, repo, branch_heads, flagged_paths, branches):
+        with self.connection:
+            for branch, commit_sha in branch_heads.items():
+                self.connection.execute('INSERT OR REPLACE INTO branch_scans VALUES (?, ?, ?)', (repo, branch, commit_sha))
+                self.connection.execute('DELETE FROM branch_flagged_paths WHERE repo = ? AND branch = ?', (repo, branch))
+                self.connection.executemany('INSERT INTO branch_flagged_paths VALUES (?, ?, ?, ?)',
+                                            ((repo, branch, path, blob_sha) for path, blob_sha in flagged_paths.get(branch, [])))
+
+            for (branch,) in self.connection.execute('SELECT branch FROM branch_scans WHERE repo = ?', (repo,)).fetchall():
+                if branch not in branches:
+                    self.connection.execute('DELETE FROM branch_scans WHERE repo = ? AND branch = ?', (repo, branch))
+                    self.connection.execute('DELETE FROM branch_flagged_paths WHERE repo = ? AND branch = ?', (repo, branch))
+
+    # (etag, last_modified, scan) stored for a URL, or None
+    def http_scan(self, url):
+        row = self.connection.execute('SELECT etag, last_modified, scan FROM http_scans WHERE url = ?', (url,)).fetchone()
+        return None if row is None else (row[0], row[1], json.loads(row[2]))
+
+    def add_http_scan(self, url, etag, last_modified, scan):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO http_scans VALUES (?, ?, ?, ?)',
+                                    (url, etag, last_modified, json.dumps(scan)))
+
+    def close(self):
+        self.connection.close()
+
+
+# Rows of the branch report for a file's findings, one per PHI type. Values that are known to not
+# be PHI were already dropped by the matcher's allowlist.
+def branch_finding_rows(file, findings):
+
+    rows = []
+
+    # Append each entry as a row in the format (script_path, phi_type, phi_values)
+    for finding in findings:
+        for phi_type, phi_values in finding.items():
+            if len(phi_values) > 0:
+                rows.append([file, phi_type, phi_values])
+
+    return rows
+
+
+# ------------------------------------------------------------
+# Findings sinks: report records are written to a sink as they are found
+# ------------------------------------------------------------
+# Columns of each report's records, and the message shown for a report with no records
+report_columns = {
+  'branches': ['branch', 'file_path', 'phi_type', 'phi_values'],
+  'history': ['commit', 'author_date', 'author_email', 'file_path', 'phi_type', 'phi_values'],
+  'issues': ['issue_title', 'phi_type', 'phi_values'],
+  'images': ['issue_title', 'image_found'],
+}
+
+report_empty_messages = {
+  'branches': 'No suspected PHI found in any script in any branch!',
+  'history': 'No suspected PHI found in any commit!',
+  'issues': 'No suspected PHI found in any Issues or Pull Requests!',
+  'images': 'No screenshots found in any Issues or Pull Requests!',
+}
+
+
+# Keeps the records of each report in memory. Subclasses write them to files instead, so a large
+# scan runs in bounded memory and the records written before a crash are kept.
+class FindingsSink:
+
+    def __init__(self):
+        self.records = {}
+
+    # Add a record (a list of values in report_columns order) to a report
+    def write(self, report, record):
+        self.records.setdefault(report, []).append(record)
+
+    # Records of a report, in the order they were written
+    def read(self, report):
+        return iter(self.records.get(report, []))
+
+    # A report as a DataFrame, assembled only when asked for
+    def dataframe(self, report):
+        records = list(self.read(report))
+        if len(records) == 0:
+            return pd.DataFrame({'message': [report_empty_messages[report]]})
+
+        return pd.DataFrame(records, columns=report_columns[report])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Writes each report to <directory>/<report>.jsonl, one JSON object per line. Every line is
+# flushed as it is written. The report files of an earlier run in the directory are removed, so a
+# report that this run does not write reads back empty.
+class JsonlFindingsSink(FindingsSink):
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.files = {}
+
+        for report in report_columns:
+            if os.path.exists(self.report_path(report)):
+                os.remove(self.report_path(report))
+
+    def report_path(self, report):
+        return os.path.join(self.directory, f'{report}.jsonl')
+
+    def write(self, report, record):
+        if report not in self.files:
+            self.files[report] = open(self.report_path(report), 'w', buffering=1)
+        self.files[report].write(json.dumps(dict(zip(report_columns[report], record))) + '\n')
+
+    def read(self, report):
+        if not os.path.exists(self.report_path(report)):
+            return
+        with open(self.report_path(report)) as file:
+            for line in file:
+                record = json.loads(line)
+                yield [record[column] for column in report_columns[report]]
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+
+# Writes each report to a Parquet dataset directory, <directory>/<report>/, one part file per
+# row_group_rows records, or fewer when a record arrives flush_seconds after the last part was
+# written. Each part is a complete Parquet file, readable even if the scan never finishes, so a
+# crash only loses the records pending since the last part; pd.read_parquet(<directory>/<report>)
+# reads the whole report. The report directories of an earlier run are removed. Needs pyarrow.
+class ParquetFindingsSink(FindingsSink):
+
+    def __init__(self, directory, row_group_rows = 10_000, flush_seconds = 30):
+        import pyarrow as pa
+
+        self.directory = directory
+        self.row_group_rows = row_group_rows
+        self.flush_seconds = flush_seconds
+        self.flushed_at = monotonic()
+        self.schemas = {report: pa.schema([(column, pa.list_(pa.string()) if column == 'phi_values' else pa.string())
+                                           for column in columns])
+                        for report, columns in report_columns.items()}
+        self.pending = {}
+        self.parts = {}
+
+        for report in report_columns:
+            shutil.rmtree(self.report_directory(report), ignore_errors=True)
+
+    def report_directory(self, report):
+        return os.path.join(self.directory, report)
+
+    def write(self, report, record):
+        if report not in self.parts:
+            os.makedirs(self.report_directory(report))
+            self.parts[report] = 0
+
+        self.pending.setdefault(report, []).append(record)
+        if len(self.pending[report]) >= self.row_group_rows:
+            self.write_part(report)
+        elif monotonic() - self.flushed_at >= self.flush_seconds:
+            self.flush()
+
+    def write_part(self, report):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        records = self.pending.pop(report, [])
+        if records:
+            table = pa.Table.from_pylist([dict(zip(report_columns[report], record)) for record in records],
+                                         schema=self.schemas[report])
+            pq.write_table(table, os.path.join(self.report_directory(report), f'part-{self.parts[report]:05d}.parquet'))
+            self.parts[report] += 1
+
+    def flush(self):
+        for report in list(self.pending):
+            self.write_part(report)
+        self.flushed_at = monotonic()
+
+    def read(self, report):
+        import pyarrow.parquet as pq
+
+        self.flush()
+        for part in range(self.parts.get(report, 0)):
+            table = pq.read_table(os.path.join(self.report_directory(report), f'part-{part:05d}.parquet'))
+            for record in table.to_pylist():
+                yield [record[column] for column in report_columns[report]]
+  
   
 
 
@@ -152,7 +1613,14 @@ def repository_phi_scan(
   github_url,
   github_username,
   github_password,
-  known_non_phi_list = []
+  known_non_phi_list = [],
+  scan_mode = 'blobs',
+  workers = 1,
+  scan_cache = None,
+  issue_mode = 'html',
+  findings_sink = None,
+  metrics_output = None,
+  trace_output = None
 ):
 
     # ------------------------------------------------------------
@@ -160,94 +1628,392 @@ def repository_phi_scan(
     # ------------------------------------------------------------
 
     # Get the repo path
-    focal_owner_repo = repo_ssh_link.split(':')[1].split('.g')[0]
+    focal_owner_repo = repository_owner_repo(repo_ssh_link)
     focal_repo = repo_ssh_link.split('/')[1].split('.g')[0]
-    write_out_focal_name = re.sub('/','_',focal_owner_repo)
+
+    # Values that are known to not be PHI, even though they're structured as such
+    allowlist = as_allowlist(known_non_phi_list)
+
+    # Findings are written to the sink as they are found
+    sink = findings_sink if findings_sink is not None else FindingsSink()
+
+    # With metrics_output or trace_output, the time of each scan phase is recorded and written out
+    with instrumented_scan(metrics_output, trace_output), scan_phase('repository_scan', repo=focal_owner_repo):
+
+        with scan_phase('branch_scan', repo=focal_owner_repo, scan_mode=scan_mode):
+            if scan_mode == 'blobs':
+                repository_blob_scan(repo_ssh_link, local_root_directory, focal_repo, sink, allowlist, workers, scan_cache)
+            elif scan_mode == 'history':
+                repository_history_scan(repo_ssh_link, local_root_directory, focal_repo, sink, allowlist, workers, scan_cache)
+            else:
+                repository_checkout_scan(repo_ssh_link, local_root_directory, focal_repo, sink, allowlist, workers)
+
+        # Persist the file findings before the Issue scan starts
+        sink.flush()
+
+        with scan_phase('issue_scan', repo=focal_owner_repo, issue_mode=issue_mode):
+            if issue_mode == 'api':
+                repository_issue_api_scan(github_url, focal_owner_repo, github_username, github_password, sink, scan_cache, allowlist)
+            else:
+                repository_issue_scan(github_url, focal_owner_repo, github_username, github_password, sink, scan_cache, allowlist)
+
+        sink.flush()
+
+    # With a findings_sink, the reports stay in the sink until read
+    if findings_sink is not None:
+        return findings_sink
+
+    branches_df = sink.dataframe('history' if scan_mode == 'history' else 'branches')
+
+    return branches_df, sink.dataframe('issues'), sink.dataframe('images')
+
+
+# 'owner/repo' of a repository's SSH link
+def repository_owner_repo(repo_ssh_link):
+    return repo_ssh_link.split(':')[1].split('.g')[0]
+
+
+# ------------------------------------------------------------
+# Function to clone a repository bare: every remote branch is a local ref, and nothing is checked out
+# ------------------------------------------------------------
+# With keep, an existing clone from an earlier run is fetched instead of cloned again
+def clone_bare_repository(repo_ssh_link, local_root_directory, focal_repo, keep = False):
+
+    repo_directory = os.path.join(local_root_directory, f'{focal_repo}.git')
+    if keep and os.path.isdir(repo_directory):
+        with scan_phase('git_fetch', repo=focal_repo):
+            subprocess.run(['git', '-C', repo_directory, 'fetch', '--quiet', '--prune', 'origin', '+refs/heads/*:refs/heads/*'],
+                           check=True)
+    else:
+        subprocess.run(['rm', '-rf', repo_directory])
+        with scan_phase('git_clone', repo=focal_repo):
+            subprocess.run(['git', 'clone', '--bare', '--quiet', repo_ssh_link, repo_directory], check=True)
+
+    return repo_directory
+
+
+# ------------------------------------------------------------
+# Function to scan the files of every remote branch from a bare clone, without checkouts
+# ------------------------------------------------------------
+# With a scan_cache (the path of a PhiScanCache database), the bare clone is kept and only fetched
+# on the next run, and only content that was not scanned before is read.
+def repository_blob_scan(repo_ssh_link, local_root_directory, focal_repo, sink, allowlist = None, workers = 1,
+                         scan_cache = None):
+
+    repo_directory = clone_bare_repository(repo_ssh_link, local_root_directory, focal_repo, keep = scan_cache is not None)
+
+    feature_branches = get_feature_branches(repo_directory)
+    cache = PhiScanCache(scan_cache, allowlist=allowlist) if scan_cache is not None else None
+
+    # Write all potential PHI information to the 'branches' report, as each blob is scanned
+    try:
+        for branch, file, findings in iter_branch_blob_phi(repo_directory, feature_branches, workers=workers,
+                                                           scan_cache=cache, repo_name=repo_ssh_link, allowlist=allowlist):
+            print(f"\nPotential PHI found in {branch}:{file}:")
+            for finding in findings:
+                print(finding)
+
+            for row in branch_finding_rows(file, findings):
+                sink.write('branches', [branch] + row)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if scan_cache is None:
+        subprocess.run(['rm', '-rf', repo_directory])
+
+
+# ------------------------------------------------------------
+# Function to scan every file version in the history of every remote branch
+# ------------------------------------------------------------
+def repository_history_scan(repo_ssh_link, local_root_directory, focal_repo, sink, allowlist = None, workers = 1,
+                            scan_cache = None):
+
+    repo_directory = clone_bare_repository(repo_ssh_link, local_root_directory, focal_repo, keep = scan_cache is not None)
+    cache = PhiScanCache(scan_cache, allowlist=allowlist) if scan_cache is not None else None
+
+    print(f'Scanning the full history of {focal_repo} for potential PHI...')
+
+    # Write all potential PHI information to the 'history' report, as the log streams by
+    try:
+        for commit, author_date, author_email, file, findings in iter_history_phi(repo_directory, workers, cache, allowlist):
+            print(f"\nPotential PHI introduced in {commit[:12]}:{file}:")
+            for finding in findings:
+                print(finding)
+
+            for row in branch_finding_rows(file, findings):
+                sink.write('history', [commit, author_date, author_email] + row)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if scan_cache is None:
+        subprocess.run(['rm', '-rf', repo_directory])
+
+
+# ------------------------------------------------------------
+# Function to scan the files of every remote branch by checking out each branch in turn
+# ------------------------------------------------------------
+# Every git command runs with `git -C`, never changing the process working directory, so several
+# repositories can be scanned concurrently in one process.
+def repository_checkout_scan(repo_ssh_link, local_root_directory, focal_repo, sink, allowlist = None, workers = 1):
 
     # Read in the focal repo from remote GitHub environment
-    os.system(f'rm -rf ~/{focal_repo}')
-    os.system(f'git clone {repo_ssh_link}')
-    os.chdir(focal_repo)
+    repo_directory = os.path.join(local_root_directory, focal_repo)
+    subprocess.run(['rm', '-rf', repo_directory])
+    with scan_phase('git_clone', repo=focal_repo):
+        subprocess.run(['git', 'clone', '--quiet', repo_ssh_link, repo_directory], check=True)
 
+    def git(*args):
+        subprocess.run(['git', '-C', repo_directory, *args], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-    # Identify all remote branches
-    feature_branches = get_feature_branches()
 
+    # Identify all remote branches
+    feature_branches = get_feature_branches(repo_directory)
 
-    # Capture all potential PHI information in a single Pandas dataframe
-    branches_df = pd.DataFrame()
 
     for branch in feature_branches:    
 
-        os.system(f'git fetch origin {branch} > /dev/null 2>&1')
-        os.system(f'git checkout -b {branch} origin/{branch} > /dev/null 2>&1')
-        os.system(f'git pull origin {branch} > /dev/null 2>&1')
+        with scan_phase('branch_checkout', repo=focal_repo, branch=branch):
+            git('fetch', 'origin', branch)
+            git('checkout', '-b', branch, f'origin/{branch}')
+            git('pull', 'origin', branch)
 
         print(f'Scanning {branch} remote branch scripts for potential PHI...')
 
-        scan_results = scan_directory_for_phi(f'{local_root_directory}{focal_repo}')
+        scan_results = scan_directory_for_phi(repo_directory, workers, allowlist)
 
         # Display and persist the results
         if scan_results:
             for file, findings in scan_results.items():    
-                # Initialize an empty list to store rows
-                rows = []
-
-                file = re.sub('{local_root_directory}', '', file)
+                file = os.path.relpath(file, repo_directory)
                 print(f"\nPotential PHI found in {file}:")
                 for finding in findings:
                     print(finding)
 
-                phi_type = list(findings[0].keys())[0]
-                phi_values = findings[0][phi_type]
-
-                # remove values that are known to not be PHI, even though they're structured as such
-                if (phi_type == 'encounter_id') & (len(known_non_phi_list) > 0):
-                    phi_values = [x for x in phi_values if x not in known_non_phi_list]
-
-                # Append each entry as a row in the format (script_path, phi_type, phi_values)
-                if len(phi_values) > 0:
-                    rows.append([file, phi_type, phi_values])
-
-                # Create the DataFrame
-                branch_df = pd.DataFrame(rows, columns=['file_path', 'phi_type', 'phi_values'])
-                branch_df['branch'] = branch
-
-                # Append to the larger set of findings
-                branches_df = pd.concat([branches_df, branch_df], axis=0).reset_index(drop=True)
+                for row in branch_finding_rows(file, findings):
+                    sink.write('branches', [branch] + row)
         else:
             print("No potential PHI found.")
 
         # Delete the feature branch reset to the main branch
-        os.chdir(f'{local_root_directory}{focal_repo}')
-        if 'main' in feature_branches:
-            os.system(f'git checkout main > /dev/null 2>&1')
-            os.system(f'git reset --hard origin/main > /dev/null 2>&1')
-        else:
-            os.system(f'git checkout master > /dev/null 2>&1')
-            os.system(f'git reset --hard origin/master > /dev/null 2>&1')
+        with scan_phase('branch_checkout', repo=focal_repo, branch=branch):
+            if 'main' in feature_branches:
+                git('checkout', 'main')
+                git('reset', '--hard', 'origin/main')
+            else:
+                git('checkout', 'master')
+                git('reset', '--hard', 'origin/master')
 
-        os.system(f'git branch -d {branch} > /dev/null 2>&1')
+            git('branch', '-d', branch)
 
 
         print(f'\n...COMPLETED SCAN FOR POTENTIAL PHI IN THE {branch} REMOTE BRANCH SCRIPTS.\n\n\n\n\n')
 
 
-    # Format the data frame for review
-    if len(branches_df) == 0:
-        branches_df = pd.DataFrame({'message': ['No suspected PHI found in any script in any branch!']})
-    else:
-        branches_df = branches_df[['branch', 'file_path', 'phi_type', 'phi_values']]
+    subprocess.run(['rm', '-rf', repo_directory])
+
+
 
-    os.chdir('..')
-    os.system(f'rm -rf ~/{focal_repo}')
 
+# ------------------------------------------------------------
+# Concurrent HTTP fetching with rate limiting and retries
+# ------------------------------------------------------------
+# Issue crawl settings: concurrent requests, request rate, and retries of failed requests
+issue_fetch_concurrency = 8
+issue_requests_per_second = 10
+issue_fetch_retries = 4
+issue_fetch_backoff_seconds = 1.0
+issue_fetch_timeout_seconds = 60
+
+
+# Token bucket: allows `rate` requests per second on average, in bursts of up to `capacity`
+class TokenBucket:
+
+    def __init__(self, rate, capacity = None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Issues GET requests of a requests.Session from asyncio, with at most `concurrency` requests in
+# flight over a pool of keep-alive connections, a request rate limit, and retries with
+# exponential backoff of connection errors, timeouts, 429 and 5xx responses (honoring Retry-After).
+class AsyncHttpFetcher:
+
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    # Settings left as None take the module's issue_fetch_* settings at the time the fetcher is created
+    def __init__(self, session, concurrency = None, requests_per_second = None, retries = None, backoff_seconds = None):
+        self.session = session
+        self.concurrency = concurrency if concurrency is not None else issue_fetch_concurrency
+        self.requests_per_second = requests_per_second if requests_per_second is not None else issue_requests_per_second
+        self.retries = retries if retries is not None else issue_fetch_retries
+        self.backoff_seconds = backoff_seconds if backoff_seconds is not None else issue_fetch_backoff_seconds
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    # The semaphore and token bucket belong to the running event loop
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.bucket = TokenBucket(self.requests_per_second)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.executor.shutdown(wait=False)
+
+    async def get(self, url, **kwargs):
+        loop = asyncio.get_running_loop()
+        kwargs.setdefault('timeout', issue_fetch_timeout_seconds)
+
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            async with self.semaphore:
+                await self.bucket.acquire()
+                count_scan_metric('http_requests')
+                try:
+                    with scan_phase('http_fetch', url=url):
+                        response = await loop.run_in_executor(self.executor, functools.partial(self.session.get, url, **kwargs))
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt == self.retries:
+                        raise
+                else:
+                    if response.status_code not in self.retry_statuses or attempt == self.retries:
+                        return response
+                    retry_after = response.headers.get('Retry-After')
+
+            count_scan_metric('http_retries')
+
+            if retry_after is not None and retry_after.isdigit():
+                delay = int(retry_after)
+            else:
+                delay = self.backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.5)
+            await asyncio.sleep(delay)
+
+
+# GET a URL and scan the response with scan(response) in a worker thread. With a scan_cache (a
+# PhiScanCache), the ETag and Last-Modified of the response are stored with the scan result, and
+# the next fetch of the URL is a conditional request: on a 304 Not Modified the stored result is
+# returned without downloading or parsing the page. Returns (scan result, links), with the links
+# of the Link header of this response (a 304 included), never stored ones: the pages of a
+# listing can change while a page itself does not.
+async def fetch_and_scan(fetcher, url, scan, params = None, scan_cache = None):
+
+    cache_key = f'{url}?{urlencode(sorted((params or {}).items()))}'
+    cached = scan_cache.http_scan(cache_key) if scan_cache is not None else None
+
+    headers = {}
+    if cached is not None:
+        etag, last_modified, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    response = await fetcher.get(url, params=params, headers=headers)
+    if cached is not None and response.status_code == 304:
+        count_scan_metric('http_not_modified')
+        return cached[2]['result'], response.links
+
+    response.raise_for_status()
+    result = await asyncio.to_thread(scan, response)
+
+    etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+    if scan_cache is not None and (etag or last_modified):
+        scan_cache.add_http_scan(cache_key, etag, last_modified, {'result': result})
+
+    return result, response.links
 
 
 
-    # ------------------------------------------------------------
-    # # Review GitHub Issues
-    # ------------------------------------------------------------
+
+# ------------------------------------------------------------
+# # Function to review GitHub Issues
+# ------------------------------------------------------------
+# (title, href) of each Issue and Pull Request row on an issues listing page
+def parse_issue_rows(html):
+
+    with scan_phase('html_parse'):
+        page_soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer(class_=re.compile(r'(^|\s)js-issue-row(\s|$)')))
+
+        rows = []
+        for issue in page_soup.find_all(class_="js-issue-row"):
+            link = issue.find('a', class_='Link--primary')
+            rows.append((link.text.strip(), link['href']))
+
+    return rows
+
+
+# Screenshots pasted into Issues and Pull Requests, as rendered HTML or as markdown
+screenshot_pattern = r'alt="image" src="https://dsghe|!\[image\]\(https://dsghe'
+
+# Finding type reported for an Issue or listing page that could not be fetched (deleted after it
+# was listed, or still failing after retries), so that it is reviewed manually
+unscanned_issue_type = 'issue_not_scanned'
+
+
+# PHI findings and screenshot images in the comments of an Issue or Pull Request page. Only the
+# comment bodies are parsed into a tree.
+def scan_issue_page(html, allowlist = None):
+
+    with scan_phase('html_parse'):
+        issue_soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer(class_='d-block user-select-contain'))
+        issue_soup_content = str(issue_soup.find_all(class_="d-block user-select-contain"))
+
+    text_findings = scan_text_for_phi(issue_soup_content, allowlist=allowlist)
+    image_findings = re.findall(screenshot_pattern, issue_soup_content)
+
+    return text_findings, image_findings
+
+
+# Fetch every listing page and every Issue and Pull Request page concurrently. Pages are parsed
+# and scanned in worker threads as they arrive, while other requests are in flight. Returns
+# [(title, text_findings, image_findings)] in listing order. A page that cannot be fetched is
+# returned as an unscanned_issue_type finding instead of failing the crawl.
+async def crawl_issues(fetcher, github_url, focal_owner_repo, total_pages, scan_cache = None, allowlist = None):
+
+    async def scan_issue(title, href_value):
+        url = f'{github_url}/{href_value}'
+        try:
+            (text_findings, image_findings), _ = await fetch_and_scan(
+              fetcher, url, lambda response: scan_issue_page(response.text, allowlist), scan_cache=scan_cache)
+        except requests.RequestException as exception:
+            return title, [{unscanned_issue_type: [f'{url}: {exception}']}], []
+        return title, text_findings, image_findings
+
+    async def scan_listing_page(page_number):
+        url = f'{github_url}/{focal_owner_repo}/issues?page={page_number}&q='
+        try:
+            issue_rows, _ = await fetch_and_scan(
+              fetcher, url, lambda response: parse_issue_rows(response.text), scan_cache=scan_cache)
+        except requests.RequestException as exception:
+            return [(f'Issues page {page_number}', [{unscanned_issue_type: [f'{url}: {exception}']}], [])]
+        return await asyncio.gather(*(scan_issue(title, href_value) for title, href_value in issue_rows))
+
+    async with fetcher:
+        pages = await asyncio.gather(*(scan_listing_page(page_number) for page_number in range(1, total_pages+1)))
+
+    return [issue for page in pages for issue in page]
+
+
+def repository_issue_scan(github_url, focal_owner_repo, github_username, github_password, sink, scan_cache = None,
+                          allowlist = None):
 
     # Create a session object
     session = requests.Session()
@@ -283,7 +2049,7 @@ def repository_phi_scan(
               soup.find_all(class_="paginate-container d-none d-sm-flex flex-sm-justify-center") \
                 [0].find('em', class_='current')['data-total-pages']
             )
-        except TypeError:
+        except (TypeError, IndexError):
             n = 1
 
         return n
@@ -291,120 +2057,347 @@ def repository_phi_scan(
     total_pages = page_counter()
 
 
+    # Crawl through each Issue and Pull Request on each webpage of the repo
+    cache = PhiScanCache(scan_cache, allowlist=allowlist) if scan_cache is not None else None
+    try:
+        issues = asyncio.run(crawl_issues(AsyncHttpFetcher(session), github_url, focal_owner_repo, total_pages, cache, allowlist))
+    finally:
+        if cache is not None:
+            cache.close()
 
-    # Define dataframes to persist findings
-    issues_df = pd.DataFrame()
-    images_df = pd.DataFrame()
+    write_issue_reports(issues, sink)
 
-    # Crawl through each Issue and Pull Request on each webpage of the repo
-    for page_number in range(1, total_pages+1):
-        issues_page_url = f'{github_url}/{focal_owner_repo}/issues?page={page_number}&q='
-        issues_page_response = session.get(issues_page_url)
-        page_soup = BeautifulSoup(issues_page_response.text, 'html.parser')
 
-        text_results = {}
-        image_results = {}
+# Write the 'issues' records (issue_title, phi_type, phi_values) and the 'images' records
+# (issue_title, 'yes') of Issues with screenshots
+def write_issue_reports(issues, sink):
 
-        # Now scrape the issues
-        issues = page_soup.find_all(class_="js-issue-row")
-        for issue in issues:
-            title = issue.find('a', class_='Link--primary').text.strip()
-            print(f"Scanning Issue: {title} for potential PHI...")
+    image_titles = set()
 
-            link = issue.find('a', class_='Link--primary')
-            href_value = link['href']
+    for title, text_findings, image_findings in issues:
+        print(f"Scanning Issue: {title} for potential PHI...")
+
+        if len(text_findings) > 0:
+            for phi in text_findings:
+                for phi_type, phi_values in phi.items():
+                    sink.write('issues', [title, phi_type, phi_values])
+
+            print(f'\t{text_findings}')
 
-            issue_page_url = f'{github_url}/{href_value}'
-            issue_page_response = session.get(issue_page_url)
-            issue_soup = BeautifulSoup(issue_page_response.text, 'html.parser')
-            issue_soup_content = issue_soup.find_all(class_="d-block user-select-contain")
+        if len(image_findings) > 0:
+            if title not in image_titles:
+                image_titles.add(title)
+                sink.write('images', [title, 'yes'])
 
+            print('\tscreenshot image found')
 
-            # Dictionary to hold text finding results
-            # -----------------------------------------------------
-            text_findings = []
+        print(f'\n')
 
-            # Scan for each pattern
-            for phi_type, pattern in patterns.items():
-                matches = re.findall(pattern, str(issue_soup_content))
-                if matches:
-                    text_findings.append({phi_type: matches})
 
-            if len(text_findings) > 0:
-                text_results[title] = text_findings
-                # Initialize an empty list to store rows
-                rows = []
+# ------------------------------------------------------------
+# # Function to review GitHub Issues through the REST API
+# ------------------------------------------------------------
+# Items per page of API listings (the API maximum)
+api_page_size = 100
 
-                # Loop through the data and unpack the information
-                for issue_title, phi_list in text_results.items():
-                    for phi in phi_list:
-                        for phi_type, phi_values in phi.items():
-                            # Append each entry as a row in the format (script_path, phi_type, phi_values)
-                            rows.append([issue_title, phi_type, phi_values])
 
-                # Create the DataFrame
-                issue_df = pd.DataFrame(rows, columns=['issue_title', 'phi_type', 'phi_values'])                
-                issues_df = pd.concat([issues_df, issue_df], axis=0)
+def github_api_url(github_url):
 
-                print(f'\t{text_findings}')
+    if urlparse(github_url).netloc == 'github.com':
+        return 'https://api.github.com'
 
+    # GitHub Enterprise Server
+    return f'{github_url.rstrip("/")}/api/v3'
 
-            # Dictionary to hold image finding results
-            # -----------------------------------------------------
-            image_findings = []
 
-            # Scan for each pattern
-            image_matches = re.findall('alt="image" src="https://dsghe', str(issue_soup_content))
-            if image_matches:
-                image_findings = image_findings+image_matches
+# Fetch every page of a paginated API listing, oldest items first, so that with a scan_cache the
+# pages of older items stay unchanged and are answered with 304 Not Modified. The first page gives
+# the number of pages (from its Link header), and the remaining pages are fetched concurrently.
+# Pages after the last one are then requested one at a time until one is empty, so items added
+# since the Link header was built (or a 304 without one) are never missed. Each page is decoded
+# and scanned with scan_page in a worker thread as it arrives. Returns the scan_page results of
+# the non-empty pages in page order.
+async def fetch_api_listing(fetcher, url, params, scan_page, scan_cache = None):
 
-            if len(image_findings) > 0:
-                image_results[title] = image_findings
-                # Initialize an empty list to store rows
-                rows = []
+    params = {**params, 'sort': 'created', 'direction': 'asc', 'per_page': api_page_size}
 
-                # Loop through the data and unpack the information
-                for issue_title, image_list in image_results.items():
-                    for image in image_list:
-                        # Append each entry as a row in the format (script_path, phi_type, phi_values)
-                        rows.append([issue_title, image])
+    def scan_response(response):
+        with scan_phase('json_parse'):
+            items = response.json()
+        return scan_page(items)
 
-                # Create the DataFrame
-                issue_images_df = pd.DataFrame(rows, columns=['issue_title', 'image'])                
-                images_df = pd.concat([images_df, issue_images_df], axis=0)
+    async def fetch_page(page_number):
+        return await fetch_and_scan(fetcher, url, scan_response, {**params, 'page': page_number}, scan_cache)
 
-                print('\tscreenshot image found')
+    first_results, links = await fetch_page(1)
 
+    last_url = links.get('last', {}).get('url')
+    last_page = int(parse_qs(urlparse(last_url).query)['page'][0]) if last_url else 1
 
-            print(f'\n')
+    pages = await asyncio.gather(*(fetch_page(page_number) for page_number in range(2, last_page+1)))
+    results = [first_results] + [page_results for page_results, _ in pages]
 
+    while results[-1]:
+        last_page += 1
+        page_results, _ = await fetch_page(last_page)
+        results.append(page_results)
 
+    return results[:-1] if len(results) > 1 else results
 
-    # Format the data frames for review
-    if len(issues_df) == 0:
-        issues_df = pd.DataFrame({'message': ['No suspected PHI found in any Issues or Pull Requests!']})
 
-    if len(images_df) == 0:
-        images_df = pd.DataFrame({'message': ['No screenshots found in any Issues or Pull Requests!']})
-    else:
-        images_df['image_found'] = 'yes'
-        images_df = images_df[['issue_title', 'image_found']].drop_duplicates()
+# (issue number, PHI findings, screenshot images) of each item's body text
+def scan_api_items(items, number_field, allowlist = None):
+
+    matcher = get_phi_matcher(allowlist=allowlist)
+    results = []
+
+    for item in items:
+        if number_field == 'number':
+            number = item['number']
+        else:
+            number = int(item[number_field].rsplit('/', 1)[1])
+
+        body = item.get('body') or ''
+        results.append((number, matcher.findings(body), re.findall(screenshot_pattern, body)))
+
+    return results
+
+
+# (issue number, title, PHI findings, screenshot images) of each Issue's description
+def scan_api_issues(items, allowlist = None):
+
+    return [(item['number'], item['title'], findings, images)
+            for item, (_, findings, images) in zip(items, scan_api_items(items, 'number', allowlist))]
+
+
+# Issues and Pull Requests with their descriptions, conversation comments, and review comments
+async def crawl_issues_api(fetcher, api_url, focal_owner_repo, scan_cache = None, allowlist = None):
+
+    async with fetcher:
+        repo_url = f'{api_url}/repos/{focal_owner_repo}'
+        issue_pages, comment_pages, review_comment_pages = await asyncio.gather(
+          fetch_api_listing(fetcher, f'{repo_url}/issues', {'state': 'all'},
+                            lambda items: scan_api_issues(items, allowlist), scan_cache),
+          fetch_api_listing(fetcher, f'{repo_url}/issues/comments', {},
+                            lambda items: scan_api_items(items, 'issue_url', allowlist), scan_cache),
+          fetch_api_listing(fetcher, f'{repo_url}/pulls/comments', {},
+                            lambda items: scan_api_items(items, 'pull_request_url', allowlist), scan_cache),
+        )
+
+    return issue_pages, comment_pages, review_comment_pages
+
+
+# Scan the body text of every Issue and Pull Request, and of their comments and review comments,
+# fetched as JSON from the GitHub REST API instead of scraping HTML pages. The password can be
+# a personal access token.
+def repository_issue_api_scan(github_url, focal_owner_repo, github_username, github_password, sink, scan_cache = None,
+                              allowlist = None):
+
+    session = requests.Session()
+    session.auth = (github_username, github_password)
+    session.headers['Accept'] = 'application/vnd.github+json'
+
+    cache = PhiScanCache(scan_cache, allowlist=allowlist) if scan_cache is not None else None
+    try:
+        issue_pages, comment_pages, review_comment_pages = asyncio.run(
+          crawl_issues_api(AsyncHttpFetcher(session), github_api_url(github_url), focal_owner_repo, cache, allowlist))
+    finally:
+        if cache is not None:
+            cache.close()
+
+    # Collect the findings and screenshots of each Issue's texts, in listing order
+    titles = {}
+    issue_findings = {}
+    issue_images = {}
+    for page in issue_pages:
+        for number, title, findings, images in page:
+            titles[number] = title
+            issue_findings[number] = [findings]
+            issue_images[number] = list(images)
+
+    for page in comment_pages + review_comment_pages:
+        for number, findings, images in page:
+            if number in titles:
+                issue_findings[number].append(findings)
+                issue_images[number] += images
+
+    matcher = get_phi_matcher()
+    issues = [(title, matcher.merge_findings(issue_findings[number]), issue_images[number]) for number, title in titles.items()]
+
+    write_issue_reports(issues, sink)
+
+
+
+
+# ------------------------------------------------------------
+# ------------------------------------------------------------
+# # Organization-wide scans of many repositories
+# ------------------------------------------------------------
+# ------------------------------------------------------------
+results_store_path = os.path.join(os.path.expanduser('~'), 'github_phi_scanning', 'scan_results.sqlite')
+
+
+# SQLite store of the reports of every scanned repository. Each report row is kept as a JSON
+# record under its repository and report name ('branches', 'issues' or 'images'), and the latest
+# scan of a repository replaces its earlier rows.
+class PhiResultsStore:
+
+    def __init__(self, path = results_store_path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS repository_scans (
+              repo TEXT PRIMARY KEY, status TEXT, error TEXT, started_at TEXT, finished_at TEXT,
+              branch_rows INTEGER, issue_rows INTEGER, image_rows INTEGER);
+            CREATE TABLE IF NOT EXISTS findings (repo TEXT, report TEXT, record TEXT);
+            CREATE INDEX IF NOT EXISTS findings_repo ON findings (repo, report);
+        ''')
+
+    # Replace a repository's reports ({report name: DataFrame}) with those of its latest scan
+    def add_scan(self, repo, reports, started_at, finished_at, error = None):
+
+        # Reports with nothing found only hold a 'message' column
+        records = {report: [] if list(report_df.columns) == ['message'] else report_df.to_dict('records')
+                   for report, report_df in reports.items()}
+
+        with self.connection:
+            self.connection.execute('DELETE FROM findings WHERE repo = ?', (repo,))
+            self.connection.executemany('INSERT INTO findings VALUES (?, ?, ?)',
+                                        ((repo, report, json.dumps(record, default=str))
+                                         for report, report_records in records.items() for record in report_records))
+            self.connection.execute('INSERT OR REPLACE INTO repository_scans VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+              repo, 'failed' if error else 'completed', error, started_at, finished_at,
+              *(len(records.get(report, [])) for report in ['branches', 'issues', 'images'])))
+
+    # All repositories' rows of a report, with a leading 'repo' column
+    def report(self, report):
+        rows = self.connection.execute('SELECT repo, record FROM findings WHERE report = ? ORDER BY rowid', (report,))
+        return pd.DataFrame([{'repo': repo, **json.loads(record)} for repo, record in rows])
+
+    def scans(self):
+        return pd.read_sql('SELECT * FROM repository_scans ORDER BY started_at', self.connection)
+
+    def close(self):
+        self.connection.close()
+
+
+# {owner/repo: (size in KB, last push time)} of each repository, from the GitHub REST API.
+# Repositories whose metadata cannot be read (an error response, a connection error or timeout
+# after all retries, or a body that is not JSON) are left out.
+async def fetch_repository_metadata(fetcher, api_url, owner_repos):
+
+    async def fetch(owner_repo):
+        try:
+            response = await fetcher.get(f'{api_url}/repos/{owner_repo}')
+            if not response.ok:
+                return owner_repo, None
+            repository = response.json()
+        except (requests.RequestException, ValueError):
+            return owner_repo, None
+        return owner_repo, (repository.get('size') or 0, repository.get('pushed_at') or '')
+
+    async with fetcher:
+        metadata = await asyncio.gather(*(fetch(owner_repo) for owner_repo in owner_repos))
+
+    return {owner_repo: values for owner_repo, values in metadata if values is not None}
+
+
+# ------------------------------------------------------------
+# Function to scan every repository of a list across a pool of concurrent scan jobs
+# ------------------------------------------------------------
+# Each repository is cloned and scanned by repository_phi_scan in its own working directory
+# (<local_root_directory>/<owner>_<repo>), with repo_workers repositories scanned at a time, and
+# its reports are written to the results store as soon as its scan ends. A repository that fails
+# to scan is recorded as failed and the other scans continue.
+# priority orders the queue: 'size' starts the largest repositories first, so that they do not
+# run alone at the end, 'pushed' starts the most recently changed ones first, and None keeps
+# the given order. Returns the scan status of every repository in the results store.
+# With metrics_output or trace_output, one ScanMetrics records the phases of every job.
+def organization_phi_scan(
+  repo_ssh_links,
+  local_root_directory,
+  github_url,
+  github_username,
+  github_password,
+  known_non_phi_list = [],
+  scan_mode = 'blobs',
+  repo_workers = 4,
+  workers = 1,
+  scan_cache = None,
+  issue_mode = 'html',
+  priority = 'size',
+  results_store = results_store_path,
+  metrics_output = None,
+  trace_output = None
+):
+
+    # One instrumented scan covers every job
+    with instrumented_scan(metrics_output, trace_output):
+
+        repo_ssh_links = list(dict.fromkeys(repo_ssh_links))
+
+        # Built once, and shared by every job
+        known_non_phi_list = as_allowlist(known_non_phi_list)
+
+        if priority is not None:
+            session = requests.Session()
+            session.auth = (github_username, github_password)
+            session.headers['Accept'] = 'application/vnd.github+json'
+            metadata = asyncio.run(fetch_repository_metadata(
+              AsyncHttpFetcher(session), github_api_url(github_url), [repository_owner_repo(link) for link in repo_ssh_links]))
+
+            sort_key = {'size': 0, 'pushed': 1}[priority]
+            repo_ssh_links.sort(key=lambda link: metadata.get(repository_owner_repo(link), (0, ''))[sort_key], reverse=True)
+
+        def scan_job(repo_ssh_link):
+
+            job_directory = os.path.join(local_root_directory, re.sub('/', '_', repository_owner_repo(repo_ssh_link)))
+            os.makedirs(job_directory, exist_ok=True)
+            started_at = datetime.now().isoformat(timespec='seconds')
+
+            try:
+                branches_df, issues_df, images_df = repository_phi_scan(
+                  repo_ssh_link, job_directory, github_url, github_username, github_password, known_non_phi_list,
+                  scan_mode, workers, scan_cache, issue_mode)
+                reports, error = {'branches': branches_df, 'issues': issues_df, 'images': images_df}, None
+            except Exception as exception:
+                reports, error = {}, f'{type(exception).__name__}: {exception}'
+
+            if scan_cache is None:
+                subprocess.run(['rm', '-rf', job_directory])
+
+            return reports, started_at, datetime.now().isoformat(timespec='seconds'), error
+
+        # Jobs start in queue order; their results are written from this thread as they complete
+        store = PhiResultsStore(results_store)
+        try:
+            with ThreadPoolExecutor(max_workers=repo_workers) as executor:
+                jobs = {executor.submit(scan_job, repo_ssh_link): repo_ssh_link for repo_ssh_link in repo_ssh_links}
+                for job in as_completed(jobs):
+                    reports, started_at, finished_at, error = job.result()
+                    store.add_scan(repository_owner_repo(jobs[job]), reports, started_at, finished_at, error)
+                    print(f'{repository_owner_repo(jobs[job])}: {"FAILED, " + error if error else "completed"}')
 
-    return branches_df, issues_df, images_df
+            return store.scans()
+        finally:
+            store.close()
 
 
   
 
 # Run the function
 # --------------------------------------------------------
-script_report, issues_text_report, issues_screenshot_report = repository_phi_scan(
-  repo_ssh_link = 'git@github.com:bshelton141/technical_examples.git',
-  local_root_directory = '/home/',
-  github_url = 'https://github.com',
-  github_username = os.getenv('public_github_username'),
-  github_password = os.getenv('public_github_password')
-)
-
-script_report
-issues_text_report
-issues_screenshot_report
+if __name__ == '__main__':
+    script_report, issues_text_report, issues_screenshot_report = repository_phi_scan(
+      repo_ssh_link = 'git@github.com:bshelton141/technical_examples.git',
+      local_root_directory = '/home/',
+      github_url = 'https://github.com',
+      github_username = os.getenv('public_github_username'),
+      github_password = os.getenv('public_github_password'),
+      workers = os.cpu_count(),
+      scan_cache = scan_cache_path
+    )
+
+    script_report
+    issues_text_report
+    issues_screenshot_report